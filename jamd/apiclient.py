@@ -0,0 +1 @@
+../recorded-jams/apiclient.py
\ No newline at end of file
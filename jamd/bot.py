@@ -3,16 +3,14 @@
 
 import sys
 import argparse
-import base64
 import http.client
 import random
-import urllib.request, urllib.parse, urllib.error
 import uuid
-import ssl
 from twisted.internet import reactor, protocol
 from twisted.python import log
 from twisted.protocols.basic import FileSender
 from song import Song
+import apiclient
 from protocol import JammrProtocol, ClientSetChannelInfo, ClientUploadIntervalBegin, ClientUploadIntervalWrite, buildMessage
 
 JAMMR_API_URL = 'https://jammr.net/api/'
@@ -20,25 +18,11 @@ SSL_VERIFY = False # development servers have self-signed certificates
 
 def jammr_api_call(url, username, password, post_data=None):
     '''Make a REST API call and return (status_code, response_body)'''
-    data = None
-    if post_data is not None:
-        data = urllib.parse.urlencode(post_data, 1).encode('utf-8')
-
-    auth = 'Basic ' + base64.b64encode(username.encode('utf-8') + b':' + password.encode('utf-8')).decode('utf-8').strip()
-
-    req = urllib.request.Request(JAMMR_API_URL + url, data, {'Authorization': auth})
-
-    ctx = ssl.create_default_context()
-    if not SSL_VERIFY:
-        ctx.check_hostname = False
-        ctx.verify_mode = ssl.CERT_NONE
-
+    client = apiclient.ApiClient(JAMMR_API_URL, username, password, ssl_verify=SSL_VERIFY)
     try:
-        resp = urllib.request.urlopen(req, context=ctx)
-    except urllib.error.URLError:
-        raise
-
-    return resp.getcode(), resp.read().decode('utf-8')
+        return client.call(url, post_data)
+    finally:
+        client.close()
 
 def jammr_api_set_token(username, password):
     '''Set the user's authentication token via the REST API and return it'''
@@ -34,6 +34,9 @@ class Jam(service.Service):
     def __init__(self, port, topic, jamd, owner=None):
         self.port = port
         self.directory = os.path.join(settings.run_dir, 'jam-%s' % port)
+        # Sessions are recorded on the session archive volume so that
+        # recorded_jamsd can start mixing them while the jam is running
+        self.session_archive_dir = os.path.join(settings.run_dir, 'session-archive', 'live', 'jam-%s' % port)
         self.owner = owner
         self.topic = topic
         self.jamd = jamd
@@ -53,9 +56,10 @@ class Jam(service.Service):
             os.mkdir(self.directory, 0o755)
         except OSError:
             pass # probably already exists
+        os.makedirs(self.session_archive_dir, 0o755, exist_ok=True)
         self.serverProcess = serverprocess.ServerProcess(settings.wahjamsrv_executable,
                 {'Port': self.port,
-                 'SessionArchive': '"%s" 60' % self.directory,
+                 'SessionArchive': '"%s" 60' % self.session_archive_dir,
                  'DefaultTopic': '"%s"' % self.topic,
                  'DefaultBPM': '%s' % settings.default_bpm,
                  'DefaultBPI': '%s' % settings.default_bpi,
@@ -96,10 +100,11 @@ class Jam(service.Service):
             self.jamd.getRedis().incr('num_public_users', amount=-self.last_num_users)
             self.last_num_users = 0
 
-        try:
-            shutil.rmtree(self.directory)
-        except OSError:
-            pass # ignore
+        for path in (self.directory, self.session_archive_dir):
+            try:
+                shutil.rmtree(path)
+            except OSError:
+                pass # ignore
         return service.Service.stopService(self)
 
     def __str__(self):
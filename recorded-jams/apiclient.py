@@ -0,0 +1,135 @@
+# Copyright 2020 Stefan Hajnoczi <stefanha@gmail.com>
+#
+# jammr REST API client that keeps connections open between calls.
+#
+# Shared by recorded-jams and jamd/bot.py (through a symlink) so the TCP and
+# TLS handshakes and loading the CA bundle are not repeated for every call.
+
+import ssl
+import time
+import base64
+import random
+import logging
+import functools
+import threading
+import http.client
+import urllib.parse
+
+__all__ = ['ApiClient']
+log = logging.getLogger(__name__)
+
+# Responses that mean the server or a proxy in front of it is overloaded or
+# restarting
+RETRY_STATUS = (http.client.BAD_GATEWAY, http.client.SERVICE_UNAVAILABLE,
+                http.client.GATEWAY_TIMEOUT)
+
+@functools.lru_cache(maxsize=None)
+def ssl_context(verify):
+    '''Return a shared SSL context, loading the CA bundle only once'''
+    ctx = ssl.create_default_context()
+    if not verify:
+        ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+    return ctx
+
+class ApiClient(object):
+    '''REST API client with a pool of keep-alive connections
+
+    Calls are retried with jittered exponential backoff when the connection
+    fails or the server is temporarily unavailable.  The API calls used by
+    jammr services are idempotent so POSTs are retried too.
+    '''
+    def __init__(self, base_url, username, password, ssl_verify=True, timeout=30,
+                 max_retries=3, retry_delay=1.0, max_idle=4):
+        url = urllib.parse.urlsplit(base_url)
+        self.https = url.scheme == 'https'
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path
+        self.auth = 'Basic ' + base64.b64encode(username.encode('utf-8') + b':' +
+                                                password.encode('utf-8')).decode('utf-8')
+        self.ssl_verify = ssl_verify
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_idle = max_idle
+        self.idle = [] # connections that can be reused
+        self.lock = threading.Lock()
+
+    def connect(self):
+        '''Return (connection, reused)'''
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        if self.https:
+            conn = http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout,
+                                               context=ssl_context(self.ssl_verify))
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return conn, False
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+    def request(self, method, url, body, headers):
+        '''Make one request and return (status_code, response_body)'''
+        conn, reused = self.connect()
+        try:
+            conn.request(method, self.path + url, body, headers)
+            resp = conn.getresponse()
+            data = resp.read()
+        except (ConnectionError, http.client.RemoteDisconnected):
+            conn.close()
+            if not reused:
+                raise
+            # The server closed the idle connection, try a new one
+            return self.request(method, url, body, headers)
+        except BaseException:
+            conn.close()
+            raise
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self.release(conn)
+        return resp.status, data.decode('utf-8')
+
+    def call(self, url, post_data=None):
+        '''Make a REST API call and return (status_code, response_body)'''
+        headers = {'Authorization': self.auth}
+        body = None
+        method = 'GET'
+        if post_data is not None:
+            method = 'POST'
+            body = urllib.parse.urlencode(post_data, 1).encode('utf-8')
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        attempt = 0
+        while True:
+            try:
+                status, data = self.request(method, url, body, headers)
+                if status not in RETRY_STATUS or attempt >= self.max_retries:
+                    return status, data
+                reason = 'HTTP status code %d' % status
+            except (OSError, http.client.HTTPException) as e:
+                if attempt >= self.max_retries:
+                    log.exception('REST API request failed')
+                    raise
+                reason = str(e) or e.__class__.__name__
+
+            # Full jitter so clients that failed together spread out
+            delay = random.uniform(0, self.retry_delay * 2 ** attempt)
+            attempt += 1
+            log.warning('REST API request %s failed (%s), retry %d in %.1f seconds' %
+                        (url, reason, attempt, delay))
+            time.sleep(delay)
@@ -12,14 +12,23 @@ import random
 import shutil
 import settings
 import mix
+import peaks
 import upload
 import jammr_api
+import dedup
+import stagestats
+from journal import Journal, JOURNAL_SUFFIX
 
 logging.basicConfig(level=logging.DEBUG)
 logging.getLogger('boto').setLevel(logging.WARNING)
 log = logging.getLogger(__name__)
 
 ISO8601_DATETIME_FMT = '%Y-%m-%dT%H:%MZ'
+ISO8601_TIME_FMT = '%H:%M:%S'
+
+# Upload state is kept next to the session's .wahjam.json descriptor like the
+# journal, see JOURNAL_SUFFIX
+UPLOAD_STATE_SUFFIX = '.upload'
 
 def random_cookie():
     '''Return random 10-character string'''
@@ -39,76 +48,225 @@ def get_users_from_clipsort_log(path):
             users.add(username)
     return users
 
-def archive_jam(session_dir, start_date):
-    # Concat interval files into per-user tracks
-    rc = mix.cliplogcvt(session_dir)
-    if rc != 0:
-        log.error('cliplogcvt %s failed with exit code %d' % (session_dir, rc))
-        sys.exit(rc)
+def get_peaks_filename(mix_filename):
+    '''Return the waveform peaks filename, sharing the mix's random cookie'''
+    return os.path.splitext(mix_filename)[0] + '.peaks'
+
+def get_stream_filenames(mix_filename):
+    '''Return (playlist, media) HLS filenames, sharing the mix's random cookie'''
+    base = os.path.splitext(mix_filename)[0]
+    return base + '.m3u8', base + '.mp4'
 
+def get_concat_tracks(session_dir):
+    '''Return (concat_filenames, users) for the per-user tracks in concat/'''
     concat_dir = os.path.join(session_dir, 'concat')
     concat_filenames = []
     users = set()
     for filename in os.listdir(concat_dir):
         concat_filenames.append(os.path.join(concat_dir, filename))
         users.add(filename.rsplit('_', 1)[0])
+    return concat_filenames, users
+
+def mix_tracks(concat_filenames, mix_filename, journal):
+    '''Mix down all tracks into an m4a file'''
+    if settings.mix_engine == 'numpy':
+        # Collect waveform peaks from the PCM while mixing
+        builder = None
+        if settings.waveform_peaks:
+            builder = peaks.PeakBuilder(mix.SAMPLE_RATE, mix.CHANNELS)
+        rc = mix.mix_numpy(concat_filenames, mix_filename, limiter=settings.mix_limiter,
+                           peaks=builder)
+    else:
+        rc = mix.mix(concat_filenames, mix_filename)
+    if rc != 0:
+        log.error('ffmpeg failed with exit code %d' % rc)
+        sys.exit(rc)
+    journal.record('mix', mix_filename=mix_filename)
+
+    if settings.mix_engine == 'numpy' and builder is not None:
+        peaks_filename = get_peaks_filename(mix_filename)
+        builder.write(peaks_filename)
+        journal.record('peaks', peaks_filename=peaks_filename)
+
+def archive_jam(session_dir, start_date, journal, stats):
+    # Each stage is recorded in the journal when it completes so a retry
+    # after a failure skips straight to the first unfinished stage.
+    if settings.dedup_intervals and journal.get('dedup') is None:
+        with stats.stage('dedup'):
+            # Before cliplogcvt so it reads repeated intervals from the page cache
+            store = dedup.dedup_session(session_dir)
+            log.info('Interval dedup ratio %.2f (%d of %d bytes saved)' %
+                     (store.ratio(), store.saved_bytes, store.total_bytes))
+            journal.record('dedup', total_bytes=store.total_bytes, saved_bytes=store.saved_bytes)
+
+    concat = journal.get('concat')
+    if concat is not None and not journal.get('mix'):
+        if not all(os.path.exists(f) for f in concat['concat_filenames']):
+            journal.forget('concat')
+            concat = None
+    if concat is None:
+        with stats.stage('concat'):
+            # Concat interval files into per-user tracks
+            rc = mix.cliplogcvt(session_dir)
+            if rc != 0:
+                log.error('cliplogcvt %s failed with exit code %d' % (session_dir, rc))
+                sys.exit(rc)
+
+            concat_filenames, users = get_concat_tracks(session_dir)
+            journal.record('concat', concat_filenames=concat_filenames, users=sorted(users))
+    else:
+        concat_filenames, users = concat['concat_filenames'], set(concat['users'])
+        log.info('Reusing concatenated tracks from a previous run')
 
     log.info('%d tracks for users: %s' % (len(concat_filenames), ', '.join(users)))
 
-    if users:
-        # Log clipsort.log for debugging
-        log.info('clipsort.log contents:')
-        with open(os.path.join(session_dir, 'clipsort.log'), 'rt') as clipsort:
-            for line in clipsort:
-                log.info(line.strip())
-        log.info('End of clipsort.log')
-
-        # Generate random filenames that are hard to guess.  The mix may be public
-        # but tracks may not be, so use different random cookies.
-        output_prefix = os.path.join(session_dir, start_date.strftime('%Y%m%d_%H%M'))
-        mix_filename = '%s_%s.m4a' % (output_prefix, random_cookie())
-        tracks_filename = '%s_%s.zip' % (output_prefix, random_cookie())
-
-        # Write zip file with per-user tracks
-        with zipfile.ZipFile(tracks_filename, 'w', zipfile.ZIP_DEFLATED) as tracks_zip:
-            for track_filename in concat_filenames:
-                tracks_zip.write(track_filename, os.path.basename(track_filename))
+    if not users:
+        return
 
-        # Mix down all tracks into an m4a file
-        rc = mix.mix(concat_filenames, mix_filename)
-        if rc != 0:
-            log.error('ffmpeg failed with exit code %d' % rc)
-            sys.exit(rc)
+    # Log clipsort.log for debugging
+    log.info('clipsort.log contents:')
+    with open(os.path.join(session_dir, 'clipsort.log'), 'rt') as clipsort:
+        for line in clipsort:
+            log.info(line.strip())
+    log.info('End of clipsort.log')
+
+    # Generate random filenames that are hard to guess.  The mix may be public
+    # but tracks may not be, so use different random cookies.
+    output_prefix = os.path.join(session_dir, start_date.strftime('%Y%m%d_%H%M'))
 
-        # Delete track files
-        for track_filename in concat_filenames:
-            os.remove(track_filename)
+    if journal.get('zip') is None:
+        with stats.stage('zip'):
+            tracks_filename = '%s_%s.zip' % (output_prefix, random_cookie())
 
-        duration = mix.get_duration(mix_filename)
+            # Write zip file with per-user tracks
+            with zipfile.ZipFile(tracks_filename, 'w', zipfile.ZIP_DEFLATED) as tracks_zip:
+                for track_filename in concat_filenames:
+                    tracks_zip.write(track_filename, os.path.basename(track_filename))
+            journal.record('zip', tracks_filename=tracks_filename)
+    tracks_filename = journal.get('zip')['tracks_filename']
 
-        add_recorded_jam = True
-        if duration < settings.min_duration:
-            log.info('Not adding recorded jam with {} duration'.format(duration))
-            add_recorded_jam = False
+    if journal.get('mix') is None:
+        with stats.stage('mix'):
+            mix_filename = '%s_%s.m4a' % (output_prefix, random_cookie())
 
-        if add_recorded_jam:
-            if settings.skip_upload:
-                mix_url = 'https://test.jammr.net/mix.m4a'
-                tracks_url = 'https://test.jammr.net/tracks.zip'
+            live = journal.get('live')
+            if live is not None and os.path.exists(live['mix_filename']):
+                # live-archive.py mixed the intervals while the jam was running
+                log.info('Using mix made while the jam was running')
+                os.rename(live['mix_filename'], mix_filename)
+                journal.record('mix', mix_filename=mix_filename)
+
+                if live['peaks_filename'] and os.path.exists(live['peaks_filename']):
+                    peaks_filename = get_peaks_filename(mix_filename)
+                    os.rename(live['peaks_filename'], peaks_filename)
+                    journal.record('peaks', peaks_filename=peaks_filename)
             else:
-                upload.override_socket_priority()
-                mix_url, tracks_url = upload.upload(settings.s3_host, settings.s3_access_key, settings.s3_secret_key,
-                                                    settings.s3_bucket, [mix_filename, tracks_filename],
-                                                    use_multipart_upload=settings.s3_multipart_upload)
-            log.info('Uploaded mix to %s' % mix_url)
-            log.info('Uploaded tracks to %s' % tracks_url)
+                mix_tracks(concat_filenames, mix_filename, journal)
+
+            # Delete track files
+            for track_filename in concat_filenames:
+                os.remove(track_filename)
+    mix_filename = journal.get('mix')['mix_filename']
 
-        if args.delete:
-            os.remove(mix_filename)
-            os.remove(tracks_filename)
+    if journal.get('peaks') is None:
+        with stats.stage('peaks') as record:
+            peaks_filename = None
+            if settings.waveform_peaks and peaks.numpy is None:
+                log.warning('numpy is not installed, skipping waveform peaks')
+            elif settings.waveform_peaks:
+                peaks_filename = get_peaks_filename(mix_filename)
+                rc = peaks.compute_peaks(mix_filename, peaks_filename)
+                record['status'] = rc
+                if rc != 0:
+                    # The recorded jam is still usable without a waveform
+                    log.error('ffmpeg failed with exit code %d while computing waveform peaks' % rc)
+                    peaks_filename = None
+            journal.record('peaks', peaks_filename=peaks_filename)
+    peaks_filename = journal.get('peaks')['peaks_filename']
 
-        if add_recorded_jam:
-            jammr_api.add_recorded_jam(start_date, users, args.owner, mix_url, tracks_url, duration, args.server)
+    if journal.get('stream') is None:
+        with stats.stage('stream') as record:
+            stream_filenames = None
+            if settings.hls_streaming:
+                playlist_filename, media_filename = get_stream_filenames(mix_filename)
+                rc = mix.segment(mix_filename, playlist_filename, media_filename,
+                                 settings.hls_segment_duration)
+                record['status'] = rc
+                if rc == 0:
+                    stream_filenames = [playlist_filename, media_filename]
+                else:
+                    # Players fall back to the m4a file
+                    log.error('ffmpeg failed with exit code %d while segmenting the mix' % rc)
+            journal.record('stream', stream_filenames=stream_filenames)
+    stream_filenames = journal.get('stream')['stream_filenames']
+
+    if journal.get('duration') is None:
+        with stats.stage('duration'):
+            duration = mix.get_duration(mix_filename)
+            journal.record('duration', duration=duration.strftime(ISO8601_TIME_FMT))
+    duration = datetime.datetime.strptime(journal.get('duration')['duration'], ISO8601_TIME_FMT).time()
+
+    add_recorded_jam = True
+    if duration < settings.min_duration:
+        log.info('Not adding recorded jam with {} duration'.format(duration))
+        add_recorded_jam = False
+
+    if add_recorded_jam:
+        if journal.get('upload') is None:
+            with stats.stage('upload') as record:
+                files = [('mix_url', mix_filename), ('tracks_url', tracks_filename)]
+                if peaks_filename:
+                    files.append(('peaks_url', peaks_filename))
+                if stream_filenames:
+                    # The playlist refers to the media file by its name
+                    files.append(('stream_url', stream_filenames[0]))
+                    files.append(('stream_media_url', stream_filenames[1]))
+                filenames = [f for _, f in files]
+                record['sent_bytes'] = sum(os.path.getsize(f) for f in filenames)
+                if settings.skip_upload:
+                    # Unique URLs because the API ignores repeated mix URLs
+                    urls = ['https://test.jammr.net/' + os.path.basename(f) for f in filenames]
+                else:
+                    upload.override_socket_priority()
+                    urls = upload.upload(settings.s3_host, settings.s3_access_key, settings.s3_secret_key,
+                                         settings.s3_bucket, filenames,
+                                         s3_port=settings.s3_port,
+                                         s3_is_secure=settings.s3_is_secure,
+                                         path_style=settings.s3_path_style,
+                                         use_multipart_upload=settings.s3_multipart_upload,
+                                         max_workers=settings.s3_upload_workers,
+                                         state_path=session_dir + UPLOAD_STATE_SUFFIX)
+                journal.record('upload', **dict(zip((k for k, _ in files), urls)))
+        uploaded = journal.get('upload')
+        mix_url = uploaded['mix_url']
+        tracks_url = uploaded['tracks_url']
+        peaks_url = uploaded.get('peaks_url')
+        stream_url = uploaded.get('stream_url')
+        log.info('Uploaded mix to %s' % mix_url)
+        log.info('Uploaded tracks to %s' % tracks_url)
+        if peaks_url:
+            log.info('Uploaded waveform peaks to %s' % peaks_url)
+        if stream_url:
+            log.info('Uploaded HLS playlist to %s' % stream_url)
+
+        # The API treats a repeated mix_url as the same recorded jam, so this
+        # is safe to retry even if the journal missed a previous success
+        if journal.get('api') is None:
+            with stats.stage('api'):
+                jammr_api.add_recorded_jam(start_date, users, args.owner, mix_url, tracks_url, duration, args.server,
+                                           peaks_url=peaks_url, stream_url=stream_url)
+                journal.record('api')
+        else:
+            log.info('Recorded jam was already added')
+
+    # Only delete outputs once everything succeeded so a retry can reuse them
+    if args.delete:
+        os.remove(mix_filename)
+        os.remove(tracks_filename)
+        if peaks_filename:
+            os.remove(peaks_filename)
+        for filename in stream_filenames or []:
+            os.remove(filename)
 
 
 parser = argparse.ArgumentParser(description='Archive jam sessions.')
@@ -117,6 +275,8 @@ parser.add_argument('--delete', action='store_true', help='delete session on suc
 parser.add_argument('session_dir', help='jam session directory (with clipsort.log)')
 parser.add_argument('start_date', help='jam session directory (with clipsort.log)')
 parser.add_argument('server', help='server where jam took place (host:port)')
+parser.add_argument('--stats', help='append per-stage resource usage to this file as JSON lines '
+                    '(recorded_jamsd passes a pipe)')
 
 if __name__ == '__main__':
     args = parser.parse_args()
@@ -134,10 +294,18 @@ if __name__ == '__main__':
     if args.owner:
         all_users.add(args.owner)
 
-    if jammr_api.can_access_recorded_jams(all_users) and cliplog_users:
-        archive_jam(session_dir, start_date)
+    journal = Journal(session_dir + JOURNAL_SUFFIX)
+    if journal.get('api') is not None:
+        log.info('Jam was already archived')
+    elif jammr_api.can_access_recorded_jams(all_users) and cliplog_users:
+        archive_jam(session_dir, start_date, journal, stagestats.StageTimer(args.stats))
     else:
         log.info('Not archiving jam')
 
     if args.delete:
         shutil.rmtree(session_dir)
+        journal.remove()
+        try:
+            os.remove(session_dir + UPLOAD_STATE_SUFFIX)
+        except FileNotFoundError:
+            pass
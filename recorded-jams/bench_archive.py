@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# Copyright 2020 Stefan Hajnoczi <stefanha@gmail.com>
+#
+# Run archive-jam.py on a synthetic session with S3 and the jammr REST API
+# served locally and report the resource usage of each stage.
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import settings
+import s3local
+import synth_session
+
+class ApiRequestHandler(BaseHTTPRequestHandler):
+    '''Accepts every recorded jam like the jammr REST API would'''
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, body):
+        body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith('/api/can-access-recorded-jams/'):
+            self.reply(200, 'true')
+        else:
+            self.reply(404, '')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path == '/api/recorded-jams/':
+            self.server.recorded_jams += 1
+            self.reply(201, '')
+        else:
+            self.reply(404, '')
+
+def start_api_server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), ApiRequestHandler)
+    httpd.daemon_threads = True
+    httpd.recorded_jams = 0
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the archive pipeline.')
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--minutes', type=float, default=10)
+    parser.add_argument('--bpm', type=int, default=120)
+    parser.add_argument('--bpi', type=int, default=16)
+    parser.add_argument('--repeat-ratio', type=float, default=0.0,
+                        help='fraction of uploads that repeat the previous one byte for byte')
+    parser.add_argument('--mix-engine', default=settings.mix_engine, choices=['amix', 'numpy'])
+    parser.add_argument('--ffmpeg', default=settings.avprog, help='ffmpeg executable')
+    parser.add_argument('--ffprobe', default=settings.avprobe, help='ffprobe executable')
+    parser.add_argument('--cliplogcvt', default=settings.cliplogcvt, help='cliplogcvt executable')
+    parser.add_argument('--keep', action='store_true', help='keep the session and outputs')
+    args = parser.parse_args()
+
+    settings.avprog = args.ffmpeg
+    tmpdir = tempfile.mkdtemp(prefix='bench_archive-')
+    s3 = s3local.S3Server()
+    s3.start()
+    api = start_api_server()
+    try:
+        session_dir = synth_session.generate(tmpdir, args.users, args.minutes,
+                                             args.bpm, args.bpi,
+                                             repeat_ratio=args.repeat_ratio)
+        size = sum(os.path.getsize(os.path.join(dirpath, f))
+                   for dirpath, _, filenames in os.walk(session_dir) for f in filenames)
+        print('Session %s: %d users, %.1f minutes, %d KiB' %
+              (session_dir, args.users, args.minutes, size // 1024))
+
+        stats_filename = os.path.join(tmpdir, 'stats.jsonl')
+        env = dict(os.environ,
+                   EXTERNAL_HOSTNAME='bench.localhost', # not debug, so upload
+                   MIX_ENGINE=args.mix_engine,
+                   AVPROG=args.ffmpeg,
+                   AVPROBE=args.ffprobe,
+                   CLIPLOGCVT=args.cliplogcvt,
+                   S3_HOST=s3.host,
+                   S3_PORT=str(s3.port),
+                   S3_IS_SECURE='0',
+                   S3_PATH_STYLE='1',
+                   S3_ACCESS_KEY='bench',
+                   S3_SECRET_KEY='bench',
+                   JAMMR_API_URL='http://%s:%d/api/' % api.server_address,
+                   JAMMR_API_PASSWORD='bench')
+        script = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'archive-jam.py')
+        start_date = os.path.basename(session_dir)[:-len('.wahjam')]
+        rc = subprocess.call([sys.executable, script, '--stats', stats_filename, session_dir,
+                              '%s-%s-%sT%s:%sZ' % (start_date[0:4], start_date[4:6], start_date[6:8],
+                                                   start_date[9:11], start_date[11:13]),
+                              'localhost:10100'], env=env)
+        if rc != 0:
+            print('archive-jam.py failed with exit code %d' % rc)
+
+        records = []
+        if os.path.exists(stats_filename):
+            with open(stats_filename, 'rt') as f:
+                records = [json.loads(line) for line in f]
+
+        print('%-9s %8s %8s %12s %12s %12s' %
+              ('stage', 'wall s', 'cpu s', 'max rss KiB', 'read KiB', 'write KiB'))
+        for r in records:
+            print('%-9s %8.2f %8.2f %12d %12d %12d' %
+                  (r['stage'], r['wall'], r['cpu'], r['max_rss_kib'],
+                   r['read_bytes'] // 1024, r['write_bytes'] // 1024))
+        print('%-9s %8.2f %8.2f' % ('total', sum(r['wall'] for r in records),
+                                    sum(r['cpu'] for r in records)))
+        print('Uploaded %d objects (%d KiB), %d recorded jams added' %
+              (len(s3.objects), sum(len(d) for d in s3.objects.values()) // 1024,
+               api.recorded_jams))
+        return rc
+    finally:
+        api.shutdown()
+        s3.stop()
+        if args.keep:
+            print('Kept %s' % tmpdir)
+        else:
+            shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Copyright 2020 Stefan Hajnoczi <stefanha@gmail.com>
+#
+# Compare the amix and numpy mix engines on the bundled audio files.
+
+import os
+import sys
+import time
+import argparse
+import resource
+import tempfile
+import multiprocessing
+import settings
+import mix
+
+FIXTURES = ['drumloop.ogg', 'sine48k.ogg', 'sine44100.ogg']
+
+def run_engine(engine, input_filenames, output_filename, results):
+    '''Mix in a child process so resource usage is measured per engine'''
+    start = time.monotonic()
+    if engine == 'numpy':
+        rc = mix.mix_numpy(input_filenames, output_filename, limiter=settings.mix_limiter)
+    else:
+        rc = mix.mix(input_filenames, output_filename)
+    wall = time.monotonic() - start
+
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    results.put({
+        'rc': rc,
+        'wall': wall,
+        'cpu': children.ru_utime + children.ru_stime + self_usage.ru_utime + self_usage.ru_stime,
+        'ffmpeg_rss': children.ru_maxrss,
+        'python_rss': self_usage.ru_maxrss,
+    })
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark mix engines.')
+    parser.add_argument('--tracks', type=int, default=len(FIXTURES),
+                        help='number of tracks, the fixtures are reused if more are needed')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs per engine')
+    parser.add_argument('--ffmpeg', default=settings.avprog, help='ffmpeg executable')
+    args = parser.parse_args()
+
+    settings.avprog = args.ffmpeg
+    fixture_dir = os.path.dirname(os.path.realpath(__file__))
+    input_filenames = [os.path.join(fixture_dir, FIXTURES[i % len(FIXTURES)])
+                       for i in range(args.tracks)]
+
+    print('%-6s %8s %8s %12s %12s' % ('engine', 'wall s', 'cpu s', 'ffmpeg KiB', 'python KiB'))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for engine in ('amix', 'numpy'):
+            for i in range(args.repeat):
+                output_filename = os.path.join(tmpdir, '%s.m4a' % engine)
+                results = multiprocessing.Queue()
+                p = multiprocessing.Process(target=run_engine,
+                        args=(engine, input_filenames, output_filename, results))
+                p.start()
+                r = results.get()
+                p.join()
+                if r['rc'] != 0:
+                    print('%s failed with exit code %d' % (engine, r['rc']))
+                    sys.exit(1)
+                print('%-6s %8.2f %8.2f %12d %12d' % (engine, r['wall'], r['cpu'],
+                                                      r['ffmpeg_rss'], r['python_rss']))
+
+if __name__ == '__main__':
+    main()
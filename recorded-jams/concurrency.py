@@ -0,0 +1,57 @@
+# Copyright 2020 Stefan Hajnoczi <stefanha@gmail.com>
+
+import os
+
+__all__ = ['ConcurrencyLimit', 'read_load', 'read_psi']
+
+def read_load():
+    '''Return the 1 minute load average per CPU'''
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+def parse_psi(text):
+    '''Return the "some" avg10 percentage from /proc/pressure/* contents'''
+    for line in text.splitlines():
+        fields = line.split()
+        if not fields or fields[0] != 'some':
+            continue
+        for field in fields[1:]:
+            key, _, value = field.partition('=')
+            if key == 'avg10':
+                return float(value)
+    raise ValueError('missing "some avg10" in pressure data')
+
+def read_psi(resource):
+    '''Return the pressure stall percentage for "cpu" or "io", 0 if unsupported'''
+    try:
+        with open(os.path.join('/proc/pressure', resource), 'rt') as f:
+            return parse_psi(f.read())
+    except (OSError, ValueError):
+        return 0.0 # kernel without CONFIG_PSI
+
+class ConcurrencyLimit(object):
+    '''Number of archive jobs to run at once, adjusted to the host's load
+
+    The limit drops by one whenever jams are busy or the host is loaded and
+    rises by one when the host is quiet, staying between floor and ceiling.
+    Between the low and high thresholds it is left alone so the limit does
+    not flap as our own jobs add to the load.
+    '''
+    def __init__(self, floor, ceiling, load_low, load_high, psi_low, psi_high, busy_jams):
+        self.floor = min(floor, ceiling)
+        self.ceiling = ceiling
+        self.load_low = load_low
+        self.load_high = load_high
+        self.psi_low = psi_low
+        self.psi_high = psi_high
+        self.busy_jams = busy_jams
+        self.limit = self.floor
+
+    def update(self, load, cpu_psi, io_psi, active_jams):
+        '''Adjust the limit from new readings and return it'''
+        if active_jams >= self.busy_jams or \
+           load > self.load_high or \
+           max(cpu_psi, io_psi) > self.psi_high:
+            self.limit = max(self.floor, self.limit - 1)
+        elif load < self.load_low and max(cpu_psi, io_psi) < self.psi_low:
+            self.limit = min(self.ceiling, self.limit + 1)
+        return self.limit
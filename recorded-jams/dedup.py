@@ -0,0 +1,72 @@
+# Copyright 2020 Stefan Hajnoczi <stefanha@gmail.com>
+#
+# Bots and looping users upload the same interval over and over.  Identical
+# interval files in a session are replaced by hardlinks to one copy, which
+# saves disk space and lets repeated reads hit the page cache.
+
+import os
+import hashlib
+import logging
+
+__all__ = ['ClipStore', 'dedup_session']
+log = logging.getLogger(__name__)
+
+def file_hash(filename):
+    '''Return the SHA-256 hex digest of a file's contents'''
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+class ClipStore(object):
+    '''Content-addressed index of the interval files in a session'''
+    def __init__(self):
+        self.files = {} # digest -> first filename seen with that content
+        self.total_bytes = 0
+        self.saved_bytes = 0
+
+    def add(self, filename):
+        '''Link filename to an earlier file with the same contents, return its digest'''
+        st = os.stat(filename)
+        digest = file_hash(filename)
+        self.total_bytes += st.st_size
+
+        canonical = self.files.get(digest)
+        try:
+            canonical_st = os.stat(canonical) if canonical else None
+        except FileNotFoundError:
+            canonical_st = None
+        if canonical_st is None:
+            self.files[digest] = filename
+            return digest
+
+        self.saved_bytes += st.st_size
+        if (canonical_st.st_dev, canonical_st.st_ino) != (st.st_dev, st.st_ino):
+            tmp_filename = filename + '.dedup'
+            os.link(canonical, tmp_filename)
+            os.replace(tmp_filename, filename)
+        return digest
+
+    def ratio(self):
+        '''Return the bytes referenced divided by the bytes stored'''
+        stored = self.total_bytes - self.saved_bytes
+        return self.total_bytes / stored if stored else 1.0
+
+def interval_files(session_dir):
+    '''Return interval filenames, which wahjamsrv puts in <guid[0]>/ directories'''
+    filenames = []
+    for name in sorted(os.listdir(session_dir)):
+        path = os.path.join(session_dir, name)
+        if len(name) != 1 or not os.path.isdir(path):
+            continue
+        filenames.extend(os.path.join(path, f) for f in sorted(os.listdir(path))
+                         if f.endswith('.ogg'))
+    return filenames
+
+def dedup_session(session_dir):
+    '''Deduplicate all interval files in a finished session, return the ClipStore'''
+    store = ClipStore()
+    for filename in interval_files(session_dir):
+        store.add(filename)
+    return store
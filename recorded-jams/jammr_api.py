@@ -1,11 +1,10 @@
 # Copyright (C) 2013-2020 Stefan Hajnoczi <stefanha@gmail.com>
 
-import ssl
 import http.client
-import urllib.request, urllib.parse, urllib.error
+import urllib.parse
 import logging
 import settings
-import base64
+import apiclient
 
 __all__ = ['add_recorded_jam']
 log = logging.getLogger(__name__)
@@ -13,28 +12,18 @@ log = logging.getLogger(__name__)
 ISO8601_DATETIME_FMT = '%Y-%m-%dT%H:%MZ'
 ISO8601_TIME_FMT = '%H:%M:%S'
 
+client = None
+
 def jammr_api_call(url, post_data=None):
     '''Make a REST API call and return (status_code, response_body)'''
-    data = None
-    if post_data is not None:
-        data = urllib.parse.urlencode(post_data, 1).encode('utf-8')
-
-    auth = 'Basic ' + base64.b64encode(settings.jammr_user.encode('utf-8') + b':' + settings.jammr_password.encode('utf-8')).decode('utf-8').strip()
-
-    req = urllib.request.Request(settings.jammr_api_url + url, data, {'Authorization': auth})
-
-    ctx = ssl.create_default_context()
-    if not settings.ssl_verify:
-        ctx.check_hostname = False
-        ctx.verify_mode = ssl.CERT_NONE
-
-    try:
-        resp = urllib.request.urlopen(req, context=ctx)
-    except urllib.error.URLError:
-        log.exception('REST API request failed')
-        raise
-
-    return resp.getcode(), resp.read().decode('utf-8')
+    global client
+    if client is None:
+        client = apiclient.ApiClient(settings.jammr_api_url, settings.jammr_user,
+                                     settings.jammr_password,
+                                     ssl_verify=settings.ssl_verify,
+                                     timeout=settings.jammr_api_timeout,
+                                     max_retries=settings.jammr_api_retries)
+    return client.call(url, post_data)
 
 def can_access_recorded_jams(users):
     query = ''
@@ -49,7 +38,7 @@ def can_access_recorded_jams(users):
 
     return resp_body.lower() == 'true'
 
-def add_recorded_jam(start_date, users, owner, mix_url, tracks_url, duration, server):
+def add_recorded_jam(start_date, users, owner, mix_url, tracks_url, duration, server, peaks_url=None, stream_url=None):
     data = {
         'start_date': start_date.strftime(ISO8601_DATETIME_FMT),
         'users': list(users),
@@ -60,9 +49,14 @@ def add_recorded_jam(start_date, users, owner, mix_url, tracks_url, duration, se
     }
     if owner:
         data['owner'] = owner
+    if peaks_url:
+        data['peaks_url'] = peaks_url
+    if stream_url:
+        data['stream_url'] = stream_url
 
+    # OK means the recorded jam already existed from an earlier attempt
     resp_code, _ = jammr_api_call('recorded-jams/', data)
-    if resp_code != http.client.CREATED:
+    if resp_code not in (http.client.CREATED, http.client.OK):
         msg = 'Unexpected HTTP status code %s' % resp_code
         log.error(msg)
         raise RuntimeError(msg)
@@ -0,0 +1,68 @@
+# Copyright 2020 Stefan Hajnoczi <stefanha@gmail.com>
+
+import os
+import time
+import heapq
+import itertools
+
+__all__ = ['JobQueue', 'session_size']
+
+class JobQueue(object):
+    '''Pending archive jobs ordered by estimated cost with aging
+
+    Jobs are keyed by session name so a session that is added twice (by the
+    startup scan and by inotify) is only queued once.
+
+    A job's priority is the time it was queued plus its estimated run time.
+    Short jobs therefore overtake long ones, but a long job is never overtaken
+    by a job queued more than its estimated run time after it.  Because the
+    waiting time counts the same for every job, priorities never need to be
+    recomputed.
+    '''
+    def __init__(self, throughput, clock=time.time):
+        self.throughput = throughput # bytes per second
+        self.clock = clock
+        self.heap = []
+        self.jobs = {} # name -> (counter value, job)
+        self.counter = itertools.count() # FIFO order for equal priorities
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __contains__(self, name):
+        return name in self.jobs
+
+    def push(self, name, job, cost):
+        '''Queue a job with cost in bytes, return False if already queued'''
+        if name in self.jobs:
+            return False
+        priority = self.clock() + cost / self.throughput
+        count = next(self.counter)
+        heapq.heappush(self.heap, (priority, count, name))
+        self.jobs[name] = (count, job)
+        return True
+
+    def pop(self):
+        '''Remove and return (name, job) of the job to run next'''
+        while True:
+            _, count, name = heapq.heappop(self.heap)
+            entry = self.jobs.get(name)
+            if entry is not None and entry[0] == count:
+                del self.jobs[name]
+                return name, entry[1]
+            # left behind by remove()
+
+    def remove(self, name):
+        '''Drop a queued job, return False if it was not queued'''
+        return self.jobs.pop(name, None) is not None
+
+def session_size(session_dir):
+    '''Return the total size in bytes of files in a session directory'''
+    total = 0
+    for dirpath, _, filenames in os.walk(session_dir):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass # deleted while walking
+    return total
@@ -0,0 +1,54 @@
+# Copyright 2020 Stefan Hajnoczi <stefanha@gmail.com>
+
+import os
+import json
+import logging
+
+__all__ = ['Journal', 'JOURNAL_SUFFIX']
+log = logging.getLogger(__name__)
+
+# Journals are kept next to the session's .wahjam.json descriptor.  The suffix
+# must not end in .json because recorded_jamsd treats those as new jobs.
+JOURNAL_SUFFIX = '.journal'
+
+class Journal(object):
+    '''Completed stages of an archive job and their outputs
+
+    The journal is saved after each stage so that a job that fails part way
+    can be retried without repeating the stages that already succeeded.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.stages = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'rt') as f:
+                    self.stages = json.load(f)
+            except ValueError:
+                log.exception('Ignoring corrupt journal %s' % path)
+
+    def get(self, stage):
+        '''Return the outputs dict of a completed stage or None'''
+        return self.stages.get(stage)
+
+    def record(self, stage, **outputs):
+        '''Mark a stage completed with JSON-serializable outputs'''
+        self.stages[stage] = outputs
+        self.save()
+
+    def forget(self, stage):
+        '''Make a stage run again, for example when its outputs disappeared'''
+        if self.stages.pop(stage, None) is not None:
+            self.save()
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wt') as f:
+            json.dump(self.stages, f)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
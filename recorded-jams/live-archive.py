@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# Copyright 2020 Stefan Hajnoczi <stefanha@gmail.com>
+#
+# Mix a jam session in chunks while wahjamsrv is still recording it so that
+# archive-jam.py only has to finish off the last few intervals.
+#
+# The session directory is moved into the session archive when the session
+# ends.  We work relative to it as the current working directory, which
+# follows the move, and take the move as the signal to finish up.
+
+import os
+import sys
+import time
+import argparse
+import logging
+import settings
+import mix
+import peaks
+import livemix
+import dedup
+from journal import Journal, JOURNAL_SUFFIX
+
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+MIX_FILENAME = 'live.m4a'
+PEAKS_FILENAME = 'live.peaks'
+
+def session_moved(live_path):
+    '''Return True once jamd has moved the session into the session archive'''
+    return os.getcwd() != live_path
+
+def live_archive(live_path):
+    cliplog = livemix.ClipLog('clipsort.log')
+    builder = None
+    if settings.waveform_peaks:
+        builder = peaks.PeakBuilder(mix.SAMPLE_RATE, mix.CHANNELS)
+    store = dedup.ClipStore() if settings.dedup_intervals else None
+    mixer = livemix.LiveMixer(MIX_FILENAME, limiter=settings.mix_limiter, peaks=builder,
+                              store=store)
+
+    last_growth = time.monotonic()
+    while True:
+        try:
+            finished = session_moved(live_path)
+        except FileNotFoundError:
+            log.error('Session directory was deleted')
+            mixer.abort()
+            return 1
+
+        # Read the log after checking for the move so no lines are missed
+        if cliplog.read():
+            last_growth = time.monotonic()
+        ready = cliplog.pop_ready(0 if finished else livemix.LAG_INTERVALS)
+        for interval in ready:
+            mixer.add(interval)
+        if ready:
+            log.info('Mixed %d intervals, %d seconds so far' %
+                     (len(ready), mixer.frames // mix.SAMPLE_RATE))
+
+        if finished:
+            break
+        if time.monotonic() - last_growth > settings.live_idle_timeout:
+            log.error('clipsort.log stopped growing, giving up')
+            mixer.abort()
+            return 1
+        time.sleep(settings.live_chunk_interval)
+
+    rc = mixer.finish()
+    if rc != 0:
+        log.error('ffmpeg failed with exit code %d' % rc)
+        return rc
+
+    session_dir = os.getcwd()
+    peaks_filename = None
+    if builder is not None:
+        peaks_filename = os.path.join(session_dir, PEAKS_FILENAME)
+        builder.write(peaks_filename)
+
+    # archive-jam.py picks this up instead of mixing the whole jam again
+    journal = Journal(session_dir + JOURNAL_SUFFIX)
+    journal.record('live',
+                   mix_filename=os.path.join(session_dir, MIX_FILENAME),
+                   peaks_filename=peaks_filename)
+    if store is not None:
+        log.info('Interval dedup ratio %.2f (%d of %d bytes saved)' %
+                 (store.ratio(), store.saved_bytes, store.total_bytes))
+    log.info('Finished live mix of %s' % session_dir)
+    return 0
+
+parser = argparse.ArgumentParser(description='Mix jam sessions while they are running.')
+parser.add_argument('session_dir', help='live jam session directory (with clipsort.log)')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if mix.numpy is None:
+        log.error('Live archiving requires the numpy package')
+        sys.exit(1)
+
+    live_path = os.path.realpath(args.session_dir)
+    os.chdir(live_path)
+    log.info('Live archiving \'%s\'...' % live_path)
+    sys.exit(live_archive(live_path))
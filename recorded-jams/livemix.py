@@ -0,0 +1,174 @@
+# Copyright 2020 Stefan Hajnoczi <stefanha@gmail.com>
+#
+# Pre-mix a jam session while wahjamsrv is still recording it.
+#
+# wahjamsrv appends to clipsort.log as intervals begin and users start
+# uploading:
+#
+#   interval <index> <bpm> <bpi>
+#   user <guid> "<username>" <channel index> <channel name>
+#
+# and writes each upload to <guid[0]>/<guid>.ogg.  An interval's uploads are
+# only complete some time after the interval ends, so intervals are mixed
+# once LAG_INTERVALS newer intervals have begun.
+
+import os
+import re
+import logging
+import collections
+import mix
+
+__all__ = ['ClipLog', 'LiveMixer']
+log = logging.getLogger(__name__)
+
+# Number of newer intervals that must have begun before an interval is mixed
+LAG_INTERVALS = 2
+
+# Number of decoded intervals kept for reuse when the same upload repeats
+DECODE_CACHE_SIZE = 16
+
+user_re = re.compile(r'user (?P<guid>\S+) "(?P<username>[^"]*)" (?P<channel>\d+)')
+
+class Interval(object):
+    def __init__(self, index, bpm, bpi):
+        self.index = index
+        self.bpm = bpm
+        self.bpi = bpi
+        self.clips = [] # [(username, filename)]
+
+    def frames(self):
+        '''Return the interval length in sample frames'''
+        return int(round(mix.SAMPLE_RATE * 60.0 * self.bpi / self.bpm))
+
+class ClipLog(object):
+    '''Incremental parser for a clipsort.log that is still being written'''
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.partial = b''
+        self.intervals = []
+
+    def read(self):
+        '''Parse lines appended since the last call, return True if any'''
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+        except FileNotFoundError:
+            return False # wahjamsrv has not created it yet
+        self.offset += len(data)
+
+        # Keep an incomplete last line until the rest of it is written
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.parse_line(line.decode('utf-8', 'replace').strip())
+        return bool(data)
+
+    def pop_ready(self, lag=LAG_INTERVALS):
+        '''Remove and return intervals followed by at least lag newer ones'''
+        count = max(0, len(self.intervals) - lag)
+        ready = self.intervals[:count]
+        del self.intervals[:count]
+        return ready
+
+    def parse_line(self, line):
+        fields = line.split()
+        if not fields:
+            return
+        if fields[0] == 'interval' and len(fields) == 4:
+            try:
+                index, bpm, bpi = int(fields[1]), float(fields[2]), int(fields[3])
+            except ValueError:
+                log.warning('Ignoring malformed clipsort.log line: %s' % line)
+                return
+            if bpm <= 0 or bpi <= 0:
+                return
+            if self.intervals and self.intervals[-1].index == index:
+                return # repeated for each upload in the same interval
+            self.intervals.append(Interval(index, bpm, bpi))
+        elif fields[0] == 'user' and self.intervals:
+            m = user_re.match(line)
+            if m:
+                guid = m.group('guid')
+                filename = os.path.join(os.path.dirname(self.path), guid[0], guid + '.ogg')
+                self.intervals[-1].clips.append((m.group('username'), filename))
+
+class LiveMixer(object):
+    '''Mix intervals in session order into an m4a file as they are completed
+
+    Intervals that nobody uploaded to are missing from clipsort.log and are
+    filled with silence based on the tempo of the previous interval.
+
+    If store (a dedup.ClipStore) is given, repeated uploads are hardlinked and
+    decoded only once.
+    '''
+    def __init__(self, output_filename, limiter=None, peaks=None, store=None):
+        self.output_filename = output_filename
+        self.limiter = limiter
+        self.peaks = peaks
+        self.store = store
+        self.decoded = collections.OrderedDict() # digest -> samples
+        self.encoder = mix.start_encoder(output_filename)
+        self.last = None # last mixed Interval
+        self.frames = 0  # sample frames written so far
+
+    def write(self, block):
+        if self.limiter is not None:
+            block = mix.soft_limit(block, self.limiter)
+        if self.peaks is not None:
+            self.peaks.add(block)
+        self.encoder.stdin.write(block.astype(mix.numpy.float32).tobytes())
+        self.frames += len(block) // mix.CHANNELS
+
+    def add(self, interval):
+        '''Mix an interval and append it to the output'''
+        if self.last is not None and interval.index > self.last.index + 1:
+            gap = interval.index - self.last.index - 1
+            silence = mix.numpy.zeros(self.last.frames() * mix.CHANNELS, dtype=mix.numpy.float32)
+            for i in range(gap):
+                self.write(silence)
+
+        block = mix.numpy.zeros(interval.frames() * mix.CHANNELS, dtype=mix.numpy.float32)
+        for username, filename in interval.clips:
+            samples = self.decode(filename)
+            if samples is None:
+                continue # skip broken uploads rather than the whole jam
+            samples = samples[:len(block)]
+            block[:len(samples)] += samples
+        self.write(block)
+        self.last = interval
+
+    def decode(self, filename):
+        if self.store is None:
+            return mix.decode_pcm(filename)
+
+        try:
+            digest = self.store.add(filename)
+        except OSError:
+            log.exception('Failed to deduplicate %s' % filename)
+            return mix.decode_pcm(filename)
+
+        samples = self.decoded.get(digest)
+        if samples is not None:
+            self.decoded.move_to_end(digest)
+            return samples
+        samples = mix.decode_pcm(filename)
+        if samples is not None:
+            self.decoded[digest] = samples
+            if len(self.decoded) > DECODE_CACHE_SIZE:
+                self.decoded.popitem(last=False)
+        return samples
+
+    def finish(self):
+        '''Finish encoding and return ffmpeg's exit code'''
+        self.encoder.stdin.close()
+        return self.encoder.wait()
+
+    def abort(self):
+        self.encoder.kill()
+        self.encoder.wait()
+        try:
+            os.remove(self.output_filename)
+        except FileNotFoundError:
+            pass
@@ -11,9 +11,23 @@ import json
 import datetime
 import settings
 
-__all__ = ['mix', 'cliplogcvt', 'get_duration']
+try:
+    import numpy
+except ImportError:
+    numpy = None # only needed by mix_numpy()
+
+__all__ = ['mix', 'mix_numpy', 'start_encoder', 'decode_pcm', 'segment', 'cliplogcvt', 'get_duration']
 log = logging.getLogger(__name__)
 
+# PCM format used between the decoders, the mixer, and the encoder
+SAMPLE_RATE = 48000
+CHANNELS = 2
+PCM_ARGS = ('-f', 'f32le', '-ar', str(SAMPLE_RATE), '-ac', str(CHANNELS))
+
+# Number of sample frames mixed at a time.  Memory use is bounded by this
+# times the number of tracks, not by the length of the jam.
+BLOCK_FRAMES = 64 * 1024
+
 def preexec_nice_down():
     '''Set the process scheduling priority to the lowest priority'''
     os.nice(19)
@@ -36,6 +50,126 @@ def mix(input_filenames, output_filename):
     log.info(' '.join(args))
     return subprocess.call(args, preexec_fn=preexec_nice_down)
 
+def soft_limit(block, threshold):
+    '''Pass samples below threshold unchanged and squash louder ones into (-1, 1)'''
+    over = numpy.abs(block) - threshold
+    knee = 1.0 - threshold
+    limited = numpy.sign(block) * (threshold + knee * numpy.tanh(over / knee))
+    return numpy.where(over > 0, limited, block)
+
+def start_encoder(output_filename):
+    '''Return an ffmpeg process that encodes PCM written to its stdin'''
+    args = [settings.avprog, '-loglevel', 'error']
+    args.extend(PCM_ARGS)
+    args.extend(('-i', 'pipe:0'))
+    args.extend(('-strict', 'experimental'))
+    args.append('-y') # overwrite output files without asking
+    args.append(output_filename)
+    log.info(' '.join(args))
+    return subprocess.Popen(args, stdin=subprocess.PIPE, preexec_fn=preexec_nice_down)
+
+def decode_pcm(filename):
+    '''Return the interleaved PCM samples of a short audio file, None on error'''
+    args = [settings.avprog, '-loglevel', 'error', '-i', filename]
+    args.extend(PCM_ARGS)
+    args.append('pipe:1')
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, preexec_fn=preexec_nice_down)
+    data, _ = process.communicate()
+    if process.returncode != 0:
+        log.error('ffmpeg failed with exit code %d decoding %s' % (process.returncode, filename))
+        return None
+    data = data[:len(data) - len(data) % (4 * CHANNELS)]
+    return numpy.frombuffer(data, dtype=numpy.float32)
+
+def mix_numpy(input_filenames, output_filename, gains=None, limiter=None, peaks=None):
+    '''Mix tracks down into a single output audio file using NumPy
+
+    Each track is decoded to PCM by its own ffmpeg process and the tracks are
+    summed block by block before being piped to an AAC encoder.  gains is an
+    optional list of linear gains per track.  limiter is the level above which
+    the soft limiter starts working, or None to sum without limiting like the
+    amix filter.  The mixed PCM is also fed to peaks (a peaks.PeakBuilder), if
+    given.
+    '''
+    if numpy is None:
+        raise RuntimeError('the numpy mix engine requires the numpy package')
+
+    if gains is None:
+        gains = [1.0] * len(input_filenames)
+    block_bytes = BLOCK_FRAMES * CHANNELS * 4
+
+    decoders = []
+    for infile in input_filenames:
+        args = [settings.avprog, '-loglevel', 'error', '-i', infile]
+        args.extend(PCM_ARGS)
+        args.append('pipe:1')
+        log.info(' '.join(args))
+        decoders.append(subprocess.Popen(args, stdout=subprocess.PIPE, preexec_fn=preexec_nice_down))
+
+    encoder = start_encoder(output_filename)
+
+    try:
+        active = list(zip(decoders, gains))
+        mixed = numpy.empty(BLOCK_FRAMES * CHANNELS, dtype=numpy.float32)
+        while active:
+            mixed.fill(0)
+            length = 0
+            for decoder, gain in list(active):
+                data = decoder.stdout.read(block_bytes)
+                if len(data) < block_bytes:
+                    active.remove((decoder, gain))
+                data = data[:len(data) - len(data) % 4]
+                if not data:
+                    continue
+                samples = numpy.frombuffer(data, dtype=numpy.float32)
+                if gain == 1.0:
+                    mixed[:len(samples)] += samples
+                else:
+                    mixed[:len(samples)] += samples * gain
+                length = max(length, len(samples))
+
+            if length == 0:
+                break
+            block = mixed[:length]
+            if limiter is not None:
+                block = soft_limit(block, limiter)
+            if peaks is not None:
+                peaks.add(block)
+            encoder.stdin.write(block.astype(numpy.float32).tobytes())
+    except BrokenPipeError:
+        log.error('ffmpeg encoder exited early')
+    finally:
+        try:
+            encoder.stdin.close()
+        except BrokenPipeError:
+            pass
+        for decoder in decoders:
+            decoder.stdout.close()
+
+    rc = encoder.wait()
+    for decoder in decoders:
+        decoder_rc = decoder.wait()
+        if decoder_rc != 0 and rc == 0:
+            rc = decoder_rc
+    return rc
+
+def segment(input_filename, playlist_filename, media_filename, segment_duration):
+    '''Remux an m4a file into an HLS playlist with fragmented MP4 media
+
+    The fragments are stored in a single media file that the playlist refers
+    to by byte range, so players fetch only the part they are playing.
+    '''
+    args = [settings.avprog, '-loglevel', 'error', '-i', input_filename,
+            '-c', 'copy', '-f', 'hls',
+            '-hls_time', str(segment_duration),
+            '-hls_playlist_type', 'vod',
+            '-hls_segment_type', 'fmp4',
+            '-hls_flags', 'single_file',
+            '-hls_segment_filename', media_filename,
+            '-y', playlist_filename]
+    log.info(' '.join(args))
+    return subprocess.call(args, preexec_fn=preexec_nice_down)
+
 def cliplogcvt(session_dir):
     '''Concatenate tracks from interval files into concat/ directory'''
     args = [settings.cliplogcvt, session_dir]
@@ -0,0 +1,141 @@
+# Copyright 2020 Stefan Hajnoczi <stefanha@gmail.com>
+#
+# Min/max waveform peaks at several zoom levels so that recorded jam pages can
+# draw a waveform without downloading the audio.
+#
+# File format (all integers little-endian):
+#
+#   magic            4 bytes  b'JPK1'
+#   sample_rate      uint32
+#   num_levels       uint32
+#   for each level:
+#     frames_per_peak  uint32
+#     num_peaks        uint32
+#   for each level, in the same order:
+#     num_peaks pairs of (min, max) int8 values, full scale is +-127
+
+import struct
+import subprocess
+import logging
+import settings
+import mix
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__all__ = ['PeakBuilder', 'compute_peaks', 'read']
+log = logging.getLogger(__name__)
+
+MAGIC = b'JPK1'
+
+# Sample frames per peak for each level, finest first.  Each level must be a
+# multiple of the first.
+LEVELS = (512, 2048, 8192, 32768)
+
+class PeakBuilder(object):
+    '''Accumulate interleaved float PCM blocks into multi-resolution peaks'''
+    def __init__(self, sample_rate, channels, levels=LEVELS):
+        if numpy is None:
+            raise RuntimeError('waveform peaks require the numpy package')
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.levels = levels
+        self.base = levels[0]
+        self.mins = []
+        self.maxs = []
+        self.leftover_min = numpy.empty(0, dtype=numpy.float32)
+        self.leftover_max = numpy.empty(0, dtype=numpy.float32)
+
+    def add(self, block):
+        '''Add a block of interleaved samples'''
+        frames = block[:len(block) - len(block) % self.channels].reshape(-1, self.channels)
+        frame_min = numpy.concatenate((self.leftover_min, frames.min(axis=1)))
+        frame_max = numpy.concatenate((self.leftover_max, frames.max(axis=1)))
+
+        whole = len(frame_min) - len(frame_min) % self.base
+        if whole:
+            self.mins.append(frame_min[:whole].reshape(-1, self.base).min(axis=1))
+            self.maxs.append(frame_max[:whole].reshape(-1, self.base).max(axis=1))
+        self.leftover_min = frame_min[whole:]
+        self.leftover_max = frame_max[whole:]
+
+    def finish(self):
+        '''Return [(frames_per_peak, mins, maxs)] for each level'''
+        mins = list(self.mins)
+        maxs = list(self.maxs)
+        if len(self.leftover_min):
+            mins.append(self.leftover_min.min(keepdims=True))
+            maxs.append(self.leftover_max.max(keepdims=True))
+        if mins:
+            mins = numpy.concatenate(mins)
+            maxs = numpy.concatenate(maxs)
+        else:
+            mins = maxs = numpy.zeros(0, dtype=numpy.float32)
+
+        result = []
+        for frames_per_peak in self.levels:
+            factor = frames_per_peak // self.base
+            pad = -len(mins) % factor
+            level_mins = numpy.pad(mins, (0, pad), 'edge' if len(mins) else 'constant')
+            level_maxs = numpy.pad(maxs, (0, pad), 'edge' if len(maxs) else 'constant')
+            result.append((frames_per_peak,
+                           level_mins.reshape(-1, factor).min(axis=1),
+                           level_maxs.reshape(-1, factor).max(axis=1)))
+        return result
+
+    def write(self, filename):
+        levels = self.finish()
+        with open(filename, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<II', self.sample_rate, len(levels)))
+            for frames_per_peak, mins, _ in levels:
+                f.write(struct.pack('<II', frames_per_peak, len(mins)))
+            for _, mins, maxs in levels:
+                pairs = numpy.empty(len(mins) * 2, dtype=numpy.int8)
+                pairs[0::2] = numpy.round(numpy.clip(mins, -1.0, 1.0) * 127)
+                pairs[1::2] = numpy.round(numpy.clip(maxs, -1.0, 1.0) * 127)
+                f.write(pairs.tobytes())
+
+def read(filename):
+    '''Return (sample_rate, [(frames_per_peak, [(min, max), ...])]) from a peaks file'''
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if data[:4] != MAGIC:
+        raise ValueError('not a peaks file')
+    sample_rate, num_levels = struct.unpack_from('<II', data, 4)
+    offset = 12
+    headers = []
+    for i in range(num_levels):
+        headers.append(struct.unpack_from('<II', data, offset))
+        offset += 8
+    levels = []
+    for frames_per_peak, num_peaks in headers:
+        values = struct.unpack_from('<%db' % (num_peaks * 2), data, offset)
+        offset += num_peaks * 2
+        levels.append((frames_per_peak, list(zip(values[0::2], values[1::2]))))
+    return sample_rate, levels
+
+def compute_peaks(input_filename, output_filename):
+    '''Decode an audio file and write its peaks file, return ffmpeg's exit code'''
+    args = [settings.avprog, '-loglevel', 'error', '-i', input_filename]
+    args.extend(mix.PCM_ARGS)
+    args.append('pipe:1')
+    log.info(' '.join(args))
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, preexec_fn=mix.preexec_nice_down)
+
+    builder = PeakBuilder(mix.SAMPLE_RATE, mix.CHANNELS)
+    block_bytes = mix.BLOCK_FRAMES * mix.CHANNELS * 4
+    while True:
+        data = process.stdout.read(block_bytes)
+        data = data[:len(data) - len(data) % 4]
+        if not data:
+            break
+        builder.add(numpy.frombuffer(data, dtype=numpy.float32))
+    process.stdout.close()
+
+    rc = process.wait()
+    if rc == 0:
+        builder.write(output_filename)
+    return rc
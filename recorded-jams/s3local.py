@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+# Copyright 2020 Stefan Hajnoczi <stefanha@gmail.com>
+#
+# Local stand-in for the parts of the S3 API that upload.py uses.  Objects are
+# kept in memory and request signatures are not checked.
+#
+# Faults can be injected to exercise retries and resuming: added latency,
+# part uploads whose connection is dropped before the reply, and 5xx errors.
+# Bytes transferred and request concurrency are counted for benchmarks.
+
+import time
+import random
+import hashlib
+import argparse
+import threading
+import functools
+import uuid
+import urllib.parse
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+__all__ = ['S3Server']
+
+def accounted(method):
+    '''Decorator that counts a request handler in the server's statistics'''
+    @functools.wraps(method)
+    def wrapper(self):
+        self.server.s3.request_started()
+        try:
+            method(self)
+        finally:
+            self.server.s3.request_finished()
+    return wrapper
+
+class S3RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass # too noisy for test runs
+
+    def inject_fault(self, part_num=None):
+        '''Apply latency and return True if the request failed on purpose
+
+        Called after the request body has been read so the connection is
+        still in a sane state if it is reused.
+        '''
+        s3 = self.server.s3
+        fault = s3.choose_fault(part_num)
+        if s3.latency:
+            time.sleep(s3.latency)
+        if fault == 'drop':
+            # The client sees the connection close without a response
+            self.close_connection = True
+            return True
+        if fault == 'error':
+            self.reply_error(503, 'SlowDown')
+            return True
+        return False
+
+    def parse_path(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        bucket, _, key = urllib.parse.unquote(url.path).lstrip('/').partition('/')
+        return bucket, key, query
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length)
+        self.server.s3.count_bytes(received=len(data))
+        return data
+
+    def reply(self, status, body=b'', headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.s3.count_bytes(sent=len(body))
+
+    def reply_xml(self, root):
+        body = b'<?xml version="1.0" encoding="UTF-8"?>\n' + ET.tostring(root)
+        self.reply(200, body, [('Content-Type', 'application/xml')])
+
+    def reply_error(self, status, code):
+        root = ET.Element('Error')
+        ET.SubElement(root, 'Code').text = code
+        body = ET.tostring(root)
+        self.reply(status, body, [('Content-Type', 'application/xml')])
+
+    @accounted
+    def do_PUT(self):
+        bucket, key, query = self.parse_path()
+        data = self.read_body()
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        s3 = self.server.s3
+
+        if 'uploadId' in query:
+            upload_id = query['uploadId'][0]
+            part_num = int(query['partNumber'][0])
+            if self.inject_fault(part_num):
+                return
+            with s3.lock:
+                if upload_id not in s3.uploads:
+                    return self.reply_error(404, 'NoSuchUpload')
+                s3.uploads[upload_id]['parts'][part_num] = (etag, data)
+        else:
+            if self.inject_fault():
+                return
+            with s3.lock:
+                s3.objects[(bucket, key)] = data
+                s3.content_types[(bucket, key)] = self.headers.get('Content-Type')
+        self.reply(200, headers=[('ETag', etag)])
+
+    @accounted
+    def do_POST(self):
+        bucket, key, query = self.parse_path()
+        body = self.read_body()
+        s3 = self.server.s3
+        if self.inject_fault():
+            return
+
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            with s3.lock:
+                s3.uploads[upload_id] = {'bucket': bucket, 'key': key, 'parts': {},
+                                         'content_type': self.headers.get('Content-Type')}
+            root = ET.Element('InitiateMultipartUploadResult')
+            ET.SubElement(root, 'Bucket').text = bucket
+            ET.SubElement(root, 'Key').text = key
+            ET.SubElement(root, 'UploadId').text = upload_id
+            return self.reply_xml(root)
+
+        if 'uploadId' in query:
+            upload_id = query['uploadId'][0]
+            requested = []
+            for part in ET.fromstring(body).iter('Part'):
+                requested.append((int(part.find('PartNumber').text),
+                                  part.find('ETag').text.strip()))
+
+            with s3.lock:
+                upload = s3.uploads.get(upload_id)
+                if upload is None:
+                    return self.reply_error(404, 'NoSuchUpload')
+                chunks = []
+                for part_num, etag in requested:
+                    stored = upload['parts'].get(part_num)
+                    if stored is None or stored[0] != etag:
+                        return self.reply_error(400, 'InvalidPart')
+                    chunks.append(stored[1])
+                data = b''.join(chunks)
+                s3.objects[(bucket, key)] = data
+                s3.content_types[(bucket, key)] = upload['content_type']
+                del s3.uploads[upload_id]
+
+            root = ET.Element('CompleteMultipartUploadResult')
+            ET.SubElement(root, 'Bucket').text = bucket
+            ET.SubElement(root, 'Key').text = key
+            ET.SubElement(root, 'ETag').text = '"%s-%d"' % (hashlib.md5(data).hexdigest(), len(requested))
+            return self.reply_xml(root)
+
+        self.reply_error(400, 'InvalidRequest')
+
+    @accounted
+    def do_DELETE(self):
+        bucket, key, query = self.parse_path()
+        s3 = self.server.s3
+        if self.inject_fault():
+            return
+        with s3.lock:
+            if 'uploadId' in query:
+                if s3.uploads.pop(query['uploadId'][0], None) is None:
+                    return self.reply_error(404, 'NoSuchUpload')
+            else:
+                s3.objects.pop((bucket, key), None)
+        self.reply(204)
+
+    @accounted
+    def do_GET(self):
+        bucket, key, query = self.parse_path()
+        s3 = self.server.s3
+        if self.inject_fault():
+            return
+
+        if 'uploadId' in query:
+            with s3.lock:
+                upload = s3.uploads.get(query['uploadId'][0])
+                if upload is None:
+                    return self.reply_error(404, 'NoSuchUpload')
+                parts = sorted((n, etag, len(data)) for n, (etag, data) in upload['parts'].items())
+            root = ET.Element('ListPartsResult')
+            ET.SubElement(root, 'Bucket').text = bucket
+            ET.SubElement(root, 'Key').text = key
+            ET.SubElement(root, 'UploadId').text = query['uploadId'][0]
+            ET.SubElement(root, 'IsTruncated').text = 'false'
+            for part_num, etag, size in parts:
+                part = ET.SubElement(root, 'Part')
+                ET.SubElement(part, 'PartNumber').text = str(part_num)
+                ET.SubElement(part, 'ETag').text = etag
+                ET.SubElement(part, 'Size').text = str(size)
+            return self.reply_xml(root)
+
+        with s3.lock:
+            data = s3.objects.get((bucket, key))
+        if data is None:
+            return self.reply_error(404, 'NoSuchKey')
+        self.reply(200, data)
+
+class S3Server(object):
+    '''In-memory S3 endpoint running in a background thread
+
+    The fault injection attributes may be changed while the server is running:
+
+    latency - seconds to wait before every response
+    error_rate - fraction of requests answered with 503 SlowDown
+    drop_rate - fraction of part uploads whose connection is closed after the
+                body was received but before the response
+    part_faults - {part_num: ['drop' or 'error', ...]}, each upload of that
+                  part takes the next fault from the list
+    '''
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0,
+                 drop_rate=0.0, seed=None):
+        self.lock = threading.Lock()
+        self.objects = {}   # (bucket, key) -> bytes
+        self.content_types = {} # (bucket, key) -> Content-Type header or None
+        self.uploads = {}   # upload_id -> {'bucket', 'key', 'parts', 'content_type'}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.part_faults = {}
+        self.random = random.Random(seed)
+        self.reset_stats()
+        self.httpd = ThreadingHTTPServer((host, port), S3RequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.s3 = self
+        self.thread = None
+
+    def choose_fault(self, part_num=None):
+        '''Return 'drop', 'error' or None for the next request'''
+        with self.lock:
+            faults = self.part_faults.get(part_num)
+            if faults:
+                fault = faults.pop(0)
+            elif part_num is not None and self.random.random() < self.drop_rate:
+                fault = 'drop'
+            elif self.random.random() < self.error_rate:
+                fault = 'error'
+            else:
+                fault = None
+            if fault == 'drop':
+                self.dropped += 1
+            elif fault == 'error':
+                self.errors += 1
+            return fault
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests = 0
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self.bytes_received = 0
+            self.bytes_sent = 0
+            self.dropped = 0
+            self.errors = 0
+            self.first_request = None # monotonic time
+            self.last_response = None
+
+    def request_started(self):
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            if self.first_request is None:
+                self.first_request = time.monotonic()
+
+    def request_finished(self):
+        with self.lock:
+            self.in_flight -= 1
+            self.last_response = time.monotonic()
+
+    def count_bytes(self, received=0, sent=0):
+        with self.lock:
+            self.bytes_received += received
+            self.bytes_sent += sent
+
+    def stats(self):
+        '''Return request, fault and throughput counters since the last reset'''
+        with self.lock:
+            elapsed = 0.0
+            if self.first_request is not None and self.last_response is not None:
+                elapsed = self.last_response - self.first_request
+            return {
+                'requests': self.requests,
+                'max_in_flight': self.max_in_flight,
+                'bytes_received': self.bytes_received,
+                'bytes_sent': self.bytes_sent,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'elapsed': elapsed,
+                'throughput': self.bytes_received / elapsed if elapsed else 0.0,
+            }
+
+    @property
+    def host(self):
+        return self.httpd.server_address[0]
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+def main():
+    parser = argparse.ArgumentParser(description='Local S3 endpoint for upload tests.')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests that fail with 503')
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help='fraction of part uploads whose connection is dropped')
+    parser.add_argument('--seed', type=int, help='random seed for repeatable faults')
+    parser.add_argument('port', type=int, nargs='?', default=9000)
+    args = parser.parse_args()
+
+    server = S3Server(port=args.port, latency=args.latency, error_rate=args.error_rate,
+                      drop_rate=args.drop_rate, seed=args.seed)
+    print('Listening on %s:%d' % (server.host, server.port))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    stats = server.stats()
+    print('%(requests)d requests, %(bytes_received)d bytes received, '
+          '%(dropped)d dropped, %(errors)d errors, '
+          '%(max_in_flight)d max in flight' % stats)
+    print('%.1f KiB/s over %.1f seconds' % (stats['throughput'] / 1024, stats['elapsed']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# Copyright 2020 Stefan Hajnoczi <stefanha@gmail.com>
+
+import os
+import heapq
+import itertools
+
+__all__ = ['SessionIndex', 'PENDING', 'ARCHIVING', 'DONE', 'headroom']
+
+# Session states
+PENDING = 'pending'     # waiting to be archived or retried
+ARCHIVING = 'archiving' # archive-jam.py or live-archive.py is using it
+DONE = 'done'           # finished or given up but still on disk
+
+def headroom(path, reserved):
+    '''Return bytes available to unprivileged users minus the reserved space'''
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize - reserved
+
+class SessionIndex(object):
+    '''Sizes and states of the sessions in the archive
+
+    policy lists the states that may be evicted, in order of preference.
+    Within a state the oldest session (by name, which starts with the session
+    date) goes first.  ARCHIVING sessions are never evicted.
+
+    Each evictable state has a heap.  Entries are not removed from the heap
+    when a session changes state, they are skipped when they reach the top
+    instead, so updates and evictions are O(log n).
+    '''
+    def __init__(self, policy):
+        if ARCHIVING in policy:
+            raise ValueError('sessions that are being archived cannot be evicted')
+        self.policy = policy
+        self.sessions = {} # name -> (state, size, seq)
+        self.heaps = dict((state, []) for state in policy)
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, name):
+        return name in self.sessions
+
+    def update(self, name, state, size=None):
+        '''Add a session or change its state, keeping the old size if none is given'''
+        old = self.sessions.get(name)
+        if size is None:
+            size = old[1] if old else 0
+        seq = next(self.counter)
+        self.sessions[name] = (state, size, seq)
+        if state in self.heaps:
+            heapq.heappush(self.heaps[state], (name, seq))
+
+    def state(self, name):
+        entry = self.sessions.get(name)
+        return entry[0] if entry else None
+
+    def remove(self, name):
+        self.sessions.pop(name, None)
+
+    def victim(self):
+        '''Return the name of the session to evict next, or None'''
+        for state in self.policy:
+            heap = self.heaps[state]
+            while heap:
+                name, seq = heap[0]
+                entry = self.sessions.get(name)
+                if entry is not None and entry[2] == seq:
+                    return name
+                heapq.heappop(heap) # stale
+        return None
+
+    def totals(self):
+        '''Return {state: (number of sessions, bytes)}'''
+        totals = {}
+        for state, size, _ in self.sessions.values():
+            count, total = totals.get(state, (0, 0))
+            totals[state] = (count + 1, total + size)
+        return totals
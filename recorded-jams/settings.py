@@ -6,8 +6,12 @@ hostname = os.environ.get('EXTERNAL_HOSTNAME') or socket.getfqdn()
 debug = hostname.startswith('dev')
 staging = hostname == 'staging.jammr.net'
 
-# DreamObjects account information
-s3_host = 'objects-us-east-1.dream.io'
+# DreamObjects account information (overridable to benchmark against
+# s3local.py)
+s3_host = os.environ.get('S3_HOST', 'objects-us-east-1.dream.io')
+s3_port = int(os.environ['S3_PORT']) if os.environ.get('S3_PORT') else None
+s3_is_secure = os.environ.get('S3_IS_SECURE', '1') == '1'
+s3_path_style = os.environ.get('S3_PATH_STYLE', '0') == '1'
 s3_access_key = os.environ.get('S3_ACCESS_KEY')
 s3_secret_key = os.environ.get('S3_SECRET_KEY')
 if staging:
@@ -16,24 +20,83 @@ else:
     s3_bucket = 'jammr'
 s3_multipart_upload = True
 
+# how many parts to upload in parallel
+s3_upload_workers = int(os.environ.get('S3_UPLOAD_WORKERS', 4))
+
 # ffmpeg-like program name
-avprog = 'ffmpeg'
-avprobe = 'ffprobe'
+avprog = os.environ.get('AVPROG', 'ffmpeg')
+avprobe = os.environ.get('AVPROBE', 'ffprobe')
+
+# Mix with ffmpeg's amix filter ('amix') or by summing decoded PCM ('numpy')
+mix_engine = os.environ.get('MIX_ENGINE', 'amix')
+
+# Level above which the numpy engine's soft limiter squashes peaks (None to
+# disable)
+mix_limiter = 0.9
+
+# Compute waveform peaks for recorded jam pages (requires numpy)
+waveform_peaks = True
+
+# Also publish the mix as an HLS playlist so players can start and seek
+# without downloading the whole file
+hls_streaming = True
+
+# Target length of HLS segments in seconds
+hls_segment_duration = 10
+
+# Hardlink identical interval files in sessions (uploads repeated by bots and
+# loops) and decode them only once while live archiving
+dedup_intervals = True
 
 # cliplogcvt program name
-cliplogcvt = '/home/recorded_jams/bin/cliplogcvt'
+cliplogcvt = os.environ.get('CLIPLOGCVT', '/home/recorded_jams/bin/cliplogcvt')
 
-# how many jams to convert in parallel
+# how many jams to convert in parallel, adjusted between these limits
+# depending on load
 max_processes = int(os.environ.get('MAX_PROCESSES', 2))
+min_processes = int(os.environ.get('MIN_PROCESSES', 1))
+
+# Number of seconds between load checks
+load_check_interval = 30
+
+# Load average per CPU below which to run more jobs and above which to run
+# fewer
+load_low = 0.5
+load_high = 0.9
+
+# CPU and IO pressure (/proc/pressure "some" avg10 percentage) below which to
+# run more jobs and above which to run fewer
+psi_low = 5.0
+psi_high = 25.0
+
+# Run fewer jobs while at least this many jams on this host have users
+busy_jams = int(os.environ.get('BUSY_JAMS', 1))
+
+# Redis server connection details (for live jam status)
+redis_addr = ('redis', 6379)
+
+# estimated archiving speed in bytes of session data per second, used to
+# order pending jams so short ones are not stuck behind long ones
+archive_throughput = 1024 * 1024
+
+# how often to retry a failed jam and the delay before the first retry (in
+# seconds), doubled for each further retry
+max_retries = 3
+retry_delay = 5 * 60
 
 # jammr REST API
 if staging:
     jammr_api_url = 'https://staging.jammr.net/api/'
 else:
     jammr_api_url = 'https://jammr.net/api/'
+jammr_api_url = os.environ.get('JAMMR_API_URL', jammr_api_url)
 jammr_user = 'recorded_jams'
 jammr_password = os.environ.get('JAMMR_API_PASSWORD')
 
+# REST API socket timeout in seconds and how often to retry failed calls
+jammr_api_timeout = 30
+jammr_api_retries = 3
+
 # Verify SSL certificates?
 ssl_verify = True
 if debug or staging:
@@ -41,6 +104,39 @@ if debug or staging:
 
 session_archive_path = '/tmp/session-archive'
 
+# Keep this much free space in the session archive by evicting sessions
+reserved_space = 2 * 1024 * 1024 * 1024
+
+# Session states to evict from, in order, oldest session first.  Sessions
+# that are being archived are never evicted.
+eviction_policy = ('done', 'pending')
+
+# Number of seconds between session archive space checks (also checked
+# whenever a new session arrives)
+space_check_interval = 60
+
+# Mix sessions while jams are still running (uses the numpy mix engine).
+# jamd records live sessions in <live_session_path>/jam-<port>/.
+live_archiving = mix_engine == 'numpy'
+live_session_path = os.path.join(session_archive_path, 'live')
+
+# Number of seconds between looking for new live sessions
+live_scan_interval = 30
+
+# Number of seconds between mixing chunks of newly completed intervals
+live_chunk_interval = 30
+
+# Give up on a live session if clipsort.log does not grow for this many
+# seconds, archive-jam.py then mixes it from scratch
+live_idle_timeout = 60 * 60
+
+# Port for the JSON status (queue depth, job ages and per-stage histograms)
+# that monitoring scrapes, 0 to disable
+stats_port = int(os.environ.get('STATS_PORT', 8100))
+
+# Number of seconds covered by the per-stage histograms
+stats_window = 60 * 60
+
 # Delete session directory after successful upload
 delete_on_success = not debug
 
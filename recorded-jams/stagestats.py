@@ -0,0 +1,170 @@
+# Copyright 2020 Stefan Hajnoczi <stefanha@gmail.com>
+#
+# Resource usage of archive pipeline stages.  Most of the work happens in
+# child processes (cliplogcvt, ffmpeg, ffprobe) so their usage is included.
+#
+# archive-jam.py writes one JSON record per stage and recorded_jamsd keeps
+# rolling histograms of them for monitoring.
+
+import json
+import time
+import bisect
+import logging
+import resource
+import contextlib
+import collections
+
+__all__ = ['StageTimer', 'RollingHistogram', 'StageStats']
+log = logging.getLogger(__name__)
+
+# ru_inblock and ru_oublock count 512-byte blocks on Linux
+BLOCK_SIZE = 512
+
+# Histogram bucket upper bounds
+SECONDS_BUCKETS = (1, 5, 15, 60, 300, 900, 3600)
+BYTES_BUCKETS = tuple(2 ** n for n in range(20, 33, 2)) # 1 MiB to 4 GiB
+
+def usage():
+    '''Return resource usage of this process plus its waited-for children'''
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'cpu': self_usage.ru_utime + self_usage.ru_stime,
+        'child_cpu': children.ru_utime + children.ru_stime,
+        'max_rss_kib': max(self_usage.ru_maxrss, children.ru_maxrss),
+        'read_bytes': (self_usage.ru_inblock + children.ru_inblock) * BLOCK_SIZE,
+        'write_bytes': (self_usage.ru_oublock + children.ru_oublock) * BLOCK_SIZE,
+    }
+
+class StageTimer(object):
+    '''Record wall time, CPU time, peak RSS, disk I/O and status of each stage
+
+    Records are logged and, if path is given, appended to it as JSON lines.
+    cpu is the total including child_cpu, the part used by child processes.
+    Peak RSS is a high-water mark over the whole process so it only shows the
+    stage that raised it.
+
+    The stage body may set further fields on the record it is given, status
+    defaults to 0 or the exit code if the stage raises SystemExit.
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self.records = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start_usage = usage()
+        start = time.monotonic()
+        record = {'stage': name, 'status': 0}
+        try:
+            yield record
+        except SystemExit as e:
+            record['status'] = e.code if isinstance(e.code, int) else 1
+            raise
+        except BaseException:
+            record['status'] = 1
+            raise
+        finally:
+            end_usage = usage()
+            record['wall'] = time.monotonic() - start
+            record['cpu'] = (end_usage['cpu'] + end_usage['child_cpu'] -
+                             start_usage['cpu'] - start_usage['child_cpu'])
+            record['child_cpu'] = end_usage['child_cpu'] - start_usage['child_cpu']
+            record['max_rss_kib'] = end_usage['max_rss_kib']
+            for field in ('read_bytes', 'write_bytes'):
+                record[field] = end_usage[field] - start_usage[field]
+            self.emit(record)
+
+    def emit(self, record):
+        self.records.append(record)
+        log.info('Stage %s took %.2f s wall, %.2f s CPU (status %s)' %
+                 (record['stage'], record['wall'], record['cpu'], record['status']))
+        if self.path:
+            with open(self.path, 'at') as f:
+                f.write(json.dumps(record) + '\n')
+
+class RollingHistogram(object):
+    '''Histogram of the values added in the last window seconds
+
+    The window is split into slots that are dropped as they expire, so the
+    histogram rolls forward in steps of window / slots.
+    '''
+    def __init__(self, buckets, window, slots=12, clock=time.monotonic):
+        self.buckets = buckets # ascending upper bounds, +Inf is implied
+        self.slot_length = window / slots
+        self.num_slots = slots
+        self.clock = clock
+        self.slots = collections.deque() # [slot number, counts, sum]
+
+    def expire(self):
+        '''Drop expired slots and return the current slot number'''
+        n = int(self.clock() // self.slot_length)
+        while self.slots and self.slots[0][0] <= n - self.num_slots:
+            self.slots.popleft()
+        return n
+
+    def add(self, value):
+        n = self.expire()
+        if not self.slots or self.slots[-1][0] != n:
+            self.slots.append([n, [0] * (len(self.buckets) + 1), 0])
+        slot = self.slots[-1]
+        slot[1][bisect.bisect_left(self.buckets, value)] += 1
+        slot[2] += value
+
+    def snapshot(self):
+        '''Return {'le': bounds, 'counts': cumulative counts, 'count', 'sum'}'''
+        self.expire()
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0
+        for _, slot_counts, slot_sum in self.slots:
+            for i, count in enumerate(slot_counts):
+                counts[i] += count
+            total += slot_sum
+        for i in range(1, len(counts)):
+            counts[i] += counts[i - 1]
+        return {
+            'le': list(self.buckets) + ['+Inf'],
+            'counts': counts,
+            'count': counts[-1],
+            'sum': total,
+        }
+
+class StageStats(object):
+    '''Rolling histograms of StageTimer records, per stage'''
+    FIELDS = (
+        ('wall', SECONDS_BUCKETS),
+        ('cpu', SECONDS_BUCKETS),
+        ('child_cpu', SECONDS_BUCKETS),
+        ('read_bytes', BYTES_BUCKETS),
+        ('write_bytes', BYTES_BUCKETS),
+    )
+
+    def __init__(self, window, slots=12, clock=time.monotonic):
+        self.window = window
+        self.slots = slots
+        self.clock = clock
+        self.stages = {} # name -> {field: RollingHistogram}
+
+    def histogram(self, buckets):
+        return RollingHistogram(buckets, self.window, self.slots, self.clock)
+
+    def add(self, record):
+        stage = self.stages.get(record['stage'])
+        if stage is None:
+            stage = dict((field, self.histogram(buckets)) for field, buckets in self.FIELDS)
+            stage['failed'] = self.histogram(()) # only counts matter
+            self.stages[record['stage']] = stage
+
+        for field, _ in self.FIELDS:
+            if field in record:
+                stage[field].add(record[field])
+        if record.get('status'):
+            stage['failed'].add(1)
+
+    def snapshot(self):
+        '''Return {stage: {field: histogram snapshot, 'failures': count}}'''
+        result = {}
+        for name, stage in self.stages.items():
+            result[name] = dict((field, stage[field].snapshot()) for field, _ in self.FIELDS)
+            result[name]['failures'] = stage['failed'].snapshot()['count']
+        return result
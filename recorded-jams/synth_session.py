@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# Copyright 2020 Stefan Hajnoczi <stefanha@gmail.com>
+#
+# Fabricate a wahjamsrv session directory from the bundled audio files for
+# benchmarking and testing the archive pipeline.
+#
+# Each user plays one of the fixtures (reused if there are more users than
+# fixtures) looped to the interval length.  The fixtures are encoded once per
+# session and every upload gets a unique Vorbis comment so that interval files
+# differ like real uploads do, except for the fraction chosen to repeat the
+# user's previous upload byte for byte like bots do.
+
+import os
+import json
+import struct
+import random
+import argparse
+import datetime
+import subprocess
+import settings
+
+__all__ = ['generate', 'write_descriptor']
+
+FIXTURES = ['drumloop.ogg', 'sine48k.ogg', 'sine44100.ogg']
+
+ISO8601_DATETIME_FMT = '%Y-%m-%dT%H:%MZ'
+
+# Replaced by a unique value in each interval file, same length
+COMMENT_PLACEHOLDER = b'0' * 32
+
+def ogg_crc_table():
+    table = []
+    for i in range(256):
+        r = i << 24
+        for _ in range(8):
+            r = ((r << 1) ^ 0x04c11db7) if r & 0x80000000 else (r << 1)
+        table.append(r & 0xffffffff)
+    return table
+
+OGG_CRC_TABLE = ogg_crc_table()
+
+def ogg_crc(data):
+    '''Return the Ogg page checksum (CRC-32, polynomial 0x04c11db7, unreflected)'''
+    crc = 0
+    for b in data:
+        crc = ((crc << 8) & 0xffffffff) ^ OGG_CRC_TABLE[(crc >> 24) ^ b]
+    return crc
+
+def uniquify(data, tag):
+    '''Return Ogg data with the comment placeholder replaced by tag (32 bytes)'''
+    offset = data.find(COMMENT_PLACEHOLDER)
+    if offset < 0:
+        raise ValueError('comment placeholder not found')
+    out = bytearray(data)
+    out[offset:offset + len(tag)] = tag
+
+    # Fix up the checksum of the page containing the comment
+    pos = 0
+    while True:
+        if out[pos:pos + 4] != b'OggS':
+            raise ValueError('invalid Ogg page at offset %d' % pos)
+        num_segments = out[pos + 26]
+        page_len = 27 + num_segments + sum(out[pos + 27:pos + 27 + num_segments])
+        if pos <= offset < pos + page_len:
+            break
+        pos += page_len
+    struct.pack_into('<I', out, pos + 22, 0)
+    struct.pack_into('<I', out, pos + 22, ogg_crc(out[pos:pos + page_len]))
+    return bytes(out)
+
+def encode_interval(fixture, seconds, output_filename):
+    '''Encode a fixture looped or cut to one interval'''
+    args = [settings.avprog, '-loglevel', 'error',
+            '-stream_loop', '-1', '-i', fixture, '-t', '%.6f' % seconds,
+            '-map_metadata', '-1', '-metadata', 'comment=' + COMMENT_PLACEHOLDER.decode(),
+            '-c:a', 'libvorbis', '-y', output_filename]
+    subprocess.check_call(args)
+    with open(output_filename, 'rb') as f:
+        return f.read()
+
+def generate(output_dir, users, minutes, bpm=120, bpi=16, repeat_ratio=0.0,
+             idle_ratio=0.1, seed=0, start_date=None):
+    '''Create a session directory in output_dir and return its path'''
+    rng = random.Random(seed)
+    if start_date is None:
+        start_date = datetime.datetime.utcnow()
+    session_dir = os.path.join(output_dir, start_date.strftime('%Y%m%d_%H%M') + '.wahjam')
+    os.mkdir(session_dir)
+
+    interval_seconds = 60.0 * bpi / bpm
+    num_intervals = max(1, int(round(minutes * 60 / interval_seconds)))
+    fixture_dir = os.path.dirname(os.path.realpath(__file__))
+    templates = {}
+    for fixture in FIXTURES[:users]:
+        filename = os.path.join(session_dir, 'template.ogg')
+        templates[fixture] = encode_interval(os.path.join(fixture_dir, fixture),
+                                             interval_seconds, filename)
+        os.remove(filename)
+
+    usernames = ['user%d' % i for i in range(users)]
+    last_upload = {}
+    with open(os.path.join(session_dir, 'clipsort.log'), 'wt') as clipsort:
+        for interval in range(num_intervals):
+            for i, username in enumerate(usernames):
+                if rng.random() < idle_ratio:
+                    continue
+
+                guid = '%032x' % rng.getrandbits(128)
+                if username in last_upload and rng.random() < repeat_ratio:
+                    data = last_upload[username]
+                else:
+                    tag = ('%032x' % rng.getrandbits(128)).encode()
+                    data = uniquify(templates[FIXTURES[i % len(FIXTURES)]], tag)
+                last_upload[username] = data
+
+                os.makedirs(os.path.join(session_dir, guid[0]), exist_ok=True)
+                with open(os.path.join(session_dir, guid[0], guid + '.ogg'), 'wb') as f:
+                    f.write(data)
+                clipsort.write('interval %d %d %d\n' % (interval, bpm, bpi))
+                clipsort.write('user %s "%s" 0 channel\n' % (guid, username))
+    return session_dir
+
+def write_descriptor(session_dir, archive_dir, port=10100):
+    '''Move a session into a session archive and write its descriptor like jamd'''
+    name = os.path.basename(session_dir)[:-len('.wahjam')]
+    start_date = datetime.datetime.strptime(name, '%Y%m%d_%H%M')
+    dest_dir = os.path.join(archive_dir, '%s_%s.wahjam' % (name, port))
+    os.rename(session_dir, dest_dir)
+    with open(dest_dir + '.json', 'wt') as f:
+        json.dump({
+            'session_dir': dest_dir,
+            'start_date': start_date.strftime(ISO8601_DATETIME_FMT),
+            'server': 'localhost:%s' % port,
+        }, f)
+    return dest_dir
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic jam session.')
+    parser.add_argument('--users', type=int, default=4)
+    parser.add_argument('--minutes', type=float, default=10)
+    parser.add_argument('--bpm', type=int, default=120)
+    parser.add_argument('--bpi', type=int, default=16)
+    parser.add_argument('--repeat-ratio', type=float, default=0.0,
+                        help='fraction of uploads that repeat the previous one byte for byte')
+    parser.add_argument('--idle-ratio', type=float, default=0.1,
+                        help='fraction of intervals in which a user sends nothing')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--archive', help='move the session into this session archive '
+                        'and write its .json descriptor for recorded_jamsd')
+    parser.add_argument('output_dir')
+    args = parser.parse_args()
+
+    session_dir = generate(args.output_dir, args.users, args.minutes, args.bpm, args.bpi,
+                           repeat_ratio=args.repeat_ratio, idle_ratio=args.idle_ratio,
+                           seed=args.seed)
+    if args.archive:
+        session_dir = write_descriptor(session_dir, args.archive)
+    print(session_dir)
+
+if __name__ == '__main__':
+    main()
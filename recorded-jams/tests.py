@@ -0,0 +1,752 @@
+#!/usr/bin/env python3
+# Copyright 2020 Stefan Hajnoczi <stefanha@gmail.com>
+#
+# Run with: python3 -m unittest tests
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import unittest
+import threading
+import subprocess
+from unittest import mock
+import upload
+import settings
+import mix
+import peaks
+import livemix
+import dedup
+import stagestats
+import apiclient
+import synth_session
+from journal import Journal
+from jobqueue import JobQueue, session_size
+from concurrency import ConcurrencyLimit, parse_psi
+from sessionindex import SessionIndex, PENDING, ARCHIVING, DONE
+from s3local import S3Server
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUCKET = 'jammr-test'
+PART_SIZE = 64 * 1024
+
+class S3TestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = S3Server()
+        self.server.start()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def make_file(self, name, size):
+        filename = os.path.join(self.tmpdir, name)
+        with open(filename, 'wb') as f:
+            f.write(os.urandom(size))
+        return filename
+
+    def upload(self, filenames, **kwargs):
+        return upload.upload(self.server.host, 'access', 'secret', BUCKET,
+                             filenames, s3_port=self.server.port,
+                             s3_is_secure=False, path_style=True,
+                             part_size=PART_SIZE, **kwargs)
+
+    def assertUploaded(self, filename):
+        with open(filename, 'rb') as f:
+            expected = f.read()
+        self.assertEqual(self.server.objects[(BUCKET, os.path.basename(filename))], expected)
+
+class UploadTestCase(S3TestCase):
+
+    def test_multipart(self):
+        filename = self.make_file('tracks.zip', PART_SIZE * 5 + 123)
+        urls = self.upload([filename])
+        self.assertEqual(urls, ['https://%s/%s/tracks.zip' % (self.server.host, BUCKET)])
+        self.assertUploaded(filename)
+        self.assertEqual(self.server.uploads, {})
+
+    def test_multipart_exact_part_size(self):
+        filename = self.make_file('tracks.zip', PART_SIZE * 2)
+        self.upload([filename])
+        self.assertUploaded(filename)
+
+    def test_multipart_empty_file(self):
+        filename = self.make_file('mix.m4a', 0)
+        self.upload([filename])
+        self.assertUploaded(filename)
+
+    def test_concurrent_files(self):
+        mix = self.make_file('mix.m4a', PART_SIZE * 3 + 1)
+        tracks = self.make_file('tracks.zip', PART_SIZE * 7 + 1)
+        urls = self.upload([mix, tracks], max_workers=3)
+        self.assertEqual([os.path.basename(u) for u in urls], ['mix.m4a', 'tracks.zip'])
+        self.assertUploaded(mix)
+        self.assertUploaded(tracks)
+
+    def test_content_type(self):
+        playlist = self.make_file('mix.m3u8', 100)
+        media = self.make_file('mix.mp4', 100)
+        self.upload([playlist])
+        self.upload([media], use_multipart_upload=False)
+        self.assertEqual(self.server.content_types[(BUCKET, 'mix.m3u8')],
+                         'application/vnd.apple.mpegurl')
+        self.assertEqual(self.server.content_types[(BUCKET, 'mix.mp4')], 'video/mp4')
+
+    def test_single_put(self):
+        filename = self.make_file('mix.m4a', PART_SIZE + 1)
+        self.upload([filename], use_multipart_upload=False)
+        self.assertUploaded(filename)
+
+class ResumeUploadTestCase(S3TestCase):
+    def setUp(self):
+        super(ResumeUploadTestCase, self).setUp()
+        self.state_path = os.path.join(self.tmpdir, 'session.wahjam.upload')
+
+    def test_resume_after_failed_part(self):
+        filename = self.make_file('tracks.zip', PART_SIZE * 4 + 1)
+
+        real_upload_part = upload.upload_part
+        def fail_part_3(buckets, state, basename, upload_id, filename, part_num, offset, size):
+            if part_num == 3:
+                raise IOError('connection reset')
+            return real_upload_part(buckets, state, basename, upload_id, filename, part_num, offset, size)
+
+        with mock.patch.object(upload, 'PART_RETRIES', 1), \
+             mock.patch.object(upload, 'upload_part', side_effect=fail_part_3):
+            self.assertRaises(IOError, self.upload, [filename], state_path=self.state_path)
+
+        # The multipart upload is kept so it can be resumed
+        self.assertEqual(len(self.server.uploads), 1)
+        state = upload.UploadState(self.state_path)
+        self.assertEqual(sorted(state.get('tracks.zip')['parts']), ['1', '2', '4', '5'])
+
+        with mock.patch.object(upload, 'upload_part', side_effect=real_upload_part) as upload_part:
+            self.upload([filename], state_path=self.state_path)
+        self.assertEqual([c[0][5] for c in upload_part.call_args_list], [3])
+        self.assertUploaded(filename)
+        self.assertEqual(self.server.uploads, {})
+
+    def test_already_uploaded(self):
+        filename = self.make_file('mix.m4a', PART_SIZE + 1)
+        self.upload([filename], state_path=self.state_path)
+        del self.server.objects[(BUCKET, 'mix.m4a')]
+
+        urls = self.upload([filename], state_path=self.state_path)
+        self.assertEqual([os.path.basename(u) for u in urls], ['mix.m4a'])
+        self.assertNotIn((BUCKET, 'mix.m4a'), self.server.objects)
+
+    def test_upload_gone(self):
+        filename = self.make_file('tracks.zip', PART_SIZE * 2 + 1)
+        state = upload.UploadState(self.state_path)
+        state.start('tracks.zip', 'no-such-upload', PART_SIZE * 2 + 1, PART_SIZE)
+        state.add_part('tracks.zip', 1, '"0123"')
+
+        self.upload([filename], state_path=self.state_path)
+        self.assertUploaded(filename)
+
+class FaultInjectionTestCase(S3TestCase):
+    def setUp(self):
+        super(FaultInjectionTestCase, self).setUp()
+        self.state_path = os.path.join(self.tmpdir, 'session.wahjam.upload')
+        patcher = mock.patch.object(upload, 'RETRY_DELAY', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_part_retried(self):
+        filename = self.make_file('tracks.zip', PART_SIZE * 4 + 1)
+        self.server.part_faults = {2: ['drop'], 3: ['error']}
+        self.upload([filename])
+        self.assertUploaded(filename)
+        stats = self.server.stats()
+        self.assertEqual((stats['dropped'], stats['errors']), (1, 1))
+
+    def test_resume_after_dropped_parts(self):
+        filename = self.make_file('tracks.zip', PART_SIZE * 4 + 1)
+        self.server.part_faults = {3: ['drop'] * 100}
+        with mock.patch.object(upload, 'PART_RETRIES', 2):
+            self.assertRaises(Exception, self.upload, [filename], state_path=self.state_path)
+        self.assertEqual(len(self.server.uploads), 1)
+
+        self.server.part_faults = {}
+        self.server.reset_stats()
+        self.upload([filename], state_path=self.state_path)
+        self.assertUploaded(filename)
+
+        # Only part 3 is sent again
+        self.assertLess(self.server.stats()['bytes_received'], PART_SIZE * 2)
+
+    def test_throughput_accounting(self):
+        mix = self.make_file('mix.m4a', PART_SIZE * 3)
+        tracks = self.make_file('tracks.zip', PART_SIZE * 3)
+        self.server.latency = 0.05
+        self.upload([mix, tracks], max_workers=3)
+        stats = self.server.stats()
+        self.assertGreaterEqual(stats['bytes_received'], PART_SIZE * 6)
+        self.assertEqual(stats['max_in_flight'], 3)
+        self.assertGreater(stats['elapsed'], 0.05)
+        self.assertGreater(stats['throughput'], 0)
+
+class JournalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'session.wahjam.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_reload(self):
+        journal = Journal(self.path)
+        self.assertIsNone(journal.get('zip'))
+        journal.record('zip', tracks_filename='tracks.zip')
+        journal.record('api')
+
+        journal = Journal(self.path)
+        self.assertEqual(journal.get('zip'), {'tracks_filename': 'tracks.zip'})
+        self.assertEqual(journal.get('api'), {})
+
+    def test_forget(self):
+        journal = Journal(self.path)
+        journal.record('concat', concat_filenames=[], users=[])
+        journal.forget('concat')
+        self.assertIsNone(Journal(self.path).get('concat'))
+
+    def test_remove(self):
+        journal = Journal(self.path)
+        journal.record('api')
+        journal.remove()
+        self.assertFalse(os.path.exists(self.path))
+        journal.remove() # already gone
+
+class JobQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.queue = JobQueue(throughput=100, clock=lambda: self.now)
+
+    def test_duplicate(self):
+        self.assertTrue(self.queue.push('a', 'job a', 100))
+        self.assertFalse(self.queue.push('a', 'job a again', 100))
+        self.assertEqual(len(self.queue), 1)
+        self.assertEqual(self.queue.pop(), ('a', 'job a'))
+        self.assertNotIn('a', self.queue)
+
+    def test_cheapest_first(self):
+        self.queue.push('big', 'big', 100000)
+        self.queue.push('small', 'small', 100)
+        self.queue.push('medium', 'medium', 1000)
+        self.assertEqual([self.queue.pop()[0] for i in range(3)], ['small', 'medium', 'big'])
+
+    def test_aging(self):
+        self.queue.push('big', 'big', 1000) # estimated 10 seconds
+        self.now = 11
+        self.queue.push('small', 'small', 100)
+        self.assertEqual(self.queue.pop()[0], 'big')
+
+    def test_fifo_for_equal_cost(self):
+        for name in 'abc':
+            self.queue.push(name, name, 100)
+        self.assertEqual([self.queue.pop()[0] for i in range(3)], ['a', 'b', 'c'])
+
+    def test_remove(self):
+        self.queue.push('a', 'a', 100)
+        self.queue.push('b', 'b', 200)
+        self.assertTrue(self.queue.remove('a'))
+        self.assertFalse(self.queue.remove('a'))
+        self.assertEqual(len(self.queue), 1)
+
+        # A job queued again after removal is not popped twice
+        self.queue.push('a', 'a2', 300)
+        self.assertEqual(self.queue.pop(), ('b', 'b'))
+        self.assertEqual(self.queue.pop(), ('a', 'a2'))
+        self.assertEqual(len(self.queue), 0)
+
+    def test_session_size(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(tmpdir, 'concat'))
+            with open(os.path.join(tmpdir, 'clipsort.log'), 'wb') as f:
+                f.write(b'x' * 10)
+            with open(os.path.join(tmpdir, 'concat', 'a_0.ogg'), 'wb') as f:
+                f.write(b'x' * 20)
+            self.assertEqual(session_size(tmpdir), 30)
+        finally:
+            shutil.rmtree(tmpdir)
+
+class SessionIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.index = SessionIndex(policy=(DONE, PENDING))
+
+    def test_policy_order(self):
+        self.index.update('20200102_1200_10100', PENDING, 100)
+        self.index.update('20200101_1200_10100', PENDING, 100)
+        self.index.update('20200103_1200_10100', DONE, 100)
+        self.assertEqual(self.index.victim(), '20200103_1200_10100')
+        self.index.remove('20200103_1200_10100')
+        self.assertEqual(self.index.victim(), '20200101_1200_10100')
+
+    def test_never_evict_archiving(self):
+        self.index.update('a', PENDING, 100)
+        self.index.update('a', ARCHIVING)
+        self.assertIsNone(self.index.victim())
+
+        # Back to pending after a failed attempt, keeping its size
+        self.index.update('a', PENDING)
+        self.assertEqual(self.index.victim(), 'a')
+        self.assertEqual(self.index.totals(), {PENDING: (1, 100)})
+
+    def test_archiving_not_allowed_in_policy(self):
+        self.assertRaises(ValueError, SessionIndex, (DONE, ARCHIVING))
+
+    def test_totals(self):
+        self.index.update('a', PENDING, 100)
+        self.index.update('b', DONE, 200)
+        self.index.update('c', DONE, 300)
+        self.assertEqual(self.index.totals(), {PENDING: (1, 100), DONE: (2, 500)})
+
+class ConcurrencyLimitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.limit = ConcurrencyLimit(floor=1, ceiling=3, load_low=0.5, load_high=0.9,
+                                      psi_low=5.0, psi_high=25.0, busy_jams=1)
+
+    def test_ramp_up_when_idle(self):
+        self.assertEqual(self.limit.limit, 1)
+        self.assertEqual(self.limit.update(0.1, 0.0, 0.0, 0), 2)
+        self.assertEqual(self.limit.update(0.1, 0.0, 0.0, 0), 3)
+        self.assertEqual(self.limit.update(0.1, 0.0, 0.0, 0), 3)
+
+    def test_back_off_when_busy(self):
+        self.limit.limit = 3
+        self.assertEqual(self.limit.update(0.1, 0.0, 0.0, 1), 2)
+        self.assertEqual(self.limit.update(1.5, 0.0, 0.0, 0), 1)
+        self.assertEqual(self.limit.update(0.1, 0.0, 30.0, 0), 1)
+
+    def test_hold_between_thresholds(self):
+        self.limit.limit = 2
+        self.assertEqual(self.limit.update(0.7, 0.0, 0.0, 0), 2)
+        self.assertEqual(self.limit.update(0.1, 10.0, 0.0, 0), 2)
+
+    def test_parse_psi(self):
+        text = 'some avg10=12.34 avg60=1.00 avg300=0.50 total=123456\n' \
+               'full avg10=1.00 avg60=0.00 avg300=0.00 total=2345\n'
+        self.assertEqual(parse_psi(text), 12.34)
+        self.assertRaises(ValueError, parse_psi, '')
+
+class ApiRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def reply(self):
+        self.server.requests.append((self.command, self.path, self.headers.get('Authorization'), self.body))
+        code = self.server.responses.pop(0) if self.server.responses else 200
+        self.send_response(code)
+        self.send_header('Content-Length', '4')
+        self.end_headers()
+        self.wfile.write(b'true')
+        if self.server.close_after_reply:
+            self.close_connection = True # without telling the client
+
+    def do_GET(self):
+        self.body = None
+        self.reply()
+
+    def do_POST(self):
+        self.body = self.rfile.read(int(self.headers['Content-Length']))
+        self.reply()
+
+class ApiClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), ApiRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.connections = 0
+        self.httpd.requests = []
+        self.httpd.responses = []
+        self.httpd.close_after_reply = False
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        self.client = apiclient.ApiClient('http://127.0.0.1:%d/api/' % self.httpd.server_address[1],
+                                          'recorded_jams', 'secret', retry_delay=0)
+
+    def tearDown(self):
+        self.client.close()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def test_keep_alive(self):
+        self.assertEqual(self.client.call('can-access-recorded-jams/?u=alice'), (200, 'true'))
+        self.assertEqual(self.client.call('recorded-jams/', {'users': ['alice', 'bob']}), (200, 'true'))
+        self.assertEqual(self.httpd.connections, 1)
+        self.assertEqual(self.httpd.requests, [
+            ('GET', '/api/can-access-recorded-jams/?u=alice', 'Basic cmVjb3JkZWRfamFtczpzZWNyZXQ=', None),
+            ('POST', '/api/recorded-jams/', 'Basic cmVjb3JkZWRfamFtczpzZWNyZXQ=',
+             b'users=alice&users=bob'),
+        ])
+
+    def test_retry(self):
+        self.httpd.responses = [503, 502]
+        self.assertEqual(self.client.call('recorded-jams/', {'users': ['alice']}), (200, 'true'))
+        self.assertEqual(len(self.httpd.requests), 3)
+
+        self.httpd.responses = [503] * 10
+        self.assertEqual(self.client.call('recorded-jams/', {'users': ['alice']})[0], 503)
+        self.assertEqual(len(self.httpd.requests), 3 + 1 + self.client.max_retries)
+
+    def test_server_closed_idle_connection(self):
+        self.httpd.close_after_reply = True
+        self.client.call('can-access-recorded-jams/')
+        time.sleep(0.1)
+        self.assertEqual(self.client.call('can-access-recorded-jams/'), (200, 'true'))
+        self.assertEqual(self.httpd.connections, 2)
+        self.assertEqual(len(self.httpd.requests), 2)
+
+    def test_connection_refused(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1] # nothing listens after close
+        client = apiclient.ApiClient('http://127.0.0.1:%d/api/' % port, 'recorded_jams', 'secret',
+                                     retry_delay=0, max_retries=1)
+        with self.assertRaises(ConnectionRefusedError):
+            client.call('can-access-recorded-jams/')
+
+@unittest.skipIf(mix.numpy is None, 'numpy not installed')
+class MixNumpyTestCase(unittest.TestCase):
+    FIXTURES = ['drumloop.ogg', 'sine48k.ogg', 'sine44100.ogg']
+
+    def test_soft_limit(self):
+        block = mix.numpy.array([0.0, 0.5, -0.5, 0.95, -3.0, 100.0], dtype=mix.numpy.float32)
+        limited = mix.soft_limit(block, 0.9)
+        self.assertEqual(list(limited[:3]), [0.0, 0.5, -0.5])
+        self.assertTrue(0.9 < limited[3] < 0.95)
+        self.assertTrue(-1.0 <= limited[4] < -0.9)
+        self.assertTrue(0.9 < limited[5] <= 1.0)
+
+    @unittest.skipIf(shutil.which(settings.avprog) is None, 'ffmpeg not installed')
+    def test_mix_fixtures(self):
+        fixture_dir = os.path.dirname(os.path.realpath(__file__))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            output_filename = os.path.join(tmpdir, 'mix.m4a')
+            rc = mix.mix_numpy([os.path.join(fixture_dir, f) for f in self.FIXTURES],
+                               output_filename, gains=[1.0, 0.5, 0.5], limiter=0.9)
+            self.assertEqual(rc, 0)
+
+            # The output decodes cleanly
+            rc = subprocess.call([settings.avprog, '-loglevel', 'error', '-i',
+                                  output_filename, '-f', 'null', '-'])
+            self.assertEqual(rc, 0)
+
+            playlist_filename = os.path.join(tmpdir, 'mix.m3u8')
+            media_filename = os.path.join(tmpdir, 'mix.mp4')
+            rc = mix.segment(output_filename, playlist_filename, media_filename, 2)
+            self.assertEqual(rc, 0)
+            with open(playlist_filename, 'rt') as f:
+                playlist = f.read()
+            self.assertIn('#EXT-X-BYTERANGE', playlist)
+            self.assertIn('\nmix.mp4\n', playlist)
+        finally:
+            shutil.rmtree(tmpdir)
+
+@unittest.skipIf(peaks.numpy is None, 'numpy not installed')
+class PeaksTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_levels(self):
+        numpy = peaks.numpy
+        builder = peaks.PeakBuilder(48000, 2, levels=(4, 8))
+        # 10 stereo frames split across blocks that do not align with peaks
+        samples = numpy.arange(20, dtype=numpy.float32) / 20.0
+        samples[1::2] *= -1
+        builder.add(samples[:6])
+        builder.add(samples[6:])
+
+        filename = os.path.join(self.tmpdir, 'mix.peaks')
+        builder.write(filename)
+        sample_rate, levels = peaks.read(filename)
+        self.assertEqual(sample_rate, 48000)
+        self.assertEqual([(n, len(p)) for n, p in levels], [(4, 3), (8, 2)])
+        self.assertEqual(levels[0][1][0], (round(-0.35 * 127), round(0.3 * 127)))
+        self.assertEqual(levels[1][1][1], (round(-0.95 * 127), round(0.9 * 127)))
+
+    def test_empty(self):
+        filename = os.path.join(self.tmpdir, 'mix.peaks')
+        peaks.PeakBuilder(48000, 2).write(filename)
+        _, levels = peaks.read(filename)
+        self.assertEqual([len(p) for _, p in levels], [0] * len(peaks.LEVELS))
+
+    @unittest.skipIf(shutil.which(settings.avprog) is None, 'ffmpeg not installed')
+    def test_compute_peaks(self):
+        fixture_dir = os.path.dirname(os.path.realpath(__file__))
+        filename = os.path.join(self.tmpdir, 'sine48k.peaks')
+        rc = peaks.compute_peaks(os.path.join(fixture_dir, 'sine48k.ogg'), filename)
+        self.assertEqual(rc, 0)
+        _, levels = peaks.read(filename)
+        coarsest = levels[-1][1]
+        self.assertTrue(coarsest)
+        self.assertTrue(all(lo < 0 < hi for lo, hi in coarsest[:-1]))
+
+class ClipLogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'clipsort.log')
+        self.cliplog = livemix.ClipLog(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def append(self, data):
+        with open(self.path, 'ab') as f:
+            f.write(data)
+
+    def test_missing_log(self):
+        self.assertFalse(self.cliplog.read())
+        self.assertEqual(self.cliplog.intervals, [])
+
+    def test_incremental(self):
+        self.append(b'interval 0 120 16\nuser ab12 "alex" 0 bass\ninterval 0 120 16\nuser cd34 "bob" 0 dru')
+        self.assertTrue(self.cliplog.read())
+        self.assertEqual(len(self.cliplog.intervals), 1)
+        self.assertEqual([u for u, _ in self.cliplog.intervals[0].clips], ['alex'])
+
+        # The rest of the partially written line
+        self.append(b'ms\ninterval 3 90 8\n')
+        self.assertTrue(self.cliplog.read())
+        self.assertFalse(self.cliplog.read())
+        first, second = self.cliplog.intervals
+        self.assertEqual(first.clips, [('alex', os.path.join(self.tmpdir, 'a', 'ab12.ogg')),
+                                       ('bob', os.path.join(self.tmpdir, 'c', 'cd34.ogg'))])
+        self.assertEqual(first.frames(), 8 * 48000)
+        self.assertEqual((second.index, second.frames()), (3, 4 * 48000 * 4 // 3))
+
+    def test_pop_ready(self):
+        for i in range(4):
+            self.append(b'interval %d 120 16\n' % i)
+        self.cliplog.read()
+        self.assertEqual([i.index for i in self.cliplog.pop_ready(2)], [0, 1])
+        self.assertEqual(self.cliplog.pop_ready(2), [])
+        self.assertEqual([i.index for i in self.cliplog.pop_ready(0)], [2, 3])
+
+class DedupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmpdir, 'a'))
+        os.mkdir(os.path.join(self.tmpdir, 'b'))
+        os.mkdir(os.path.join(self.tmpdir, 'concat'))
+        self.write('a/a1.ogg', b'loop' * 100)
+        self.write('b/b1.ogg', b'loop' * 100)
+        self.write('a/a2.ogg', b'solo' * 100)
+        self.write('b/b2.ogg', b'loop' * 100)
+        self.write('concat/alex_0.ogg', b'loop' * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, data):
+        with open(os.path.join(self.tmpdir, name), 'wb') as f:
+            f.write(data)
+
+    def inode(self, name):
+        return os.stat(os.path.join(self.tmpdir, name)).st_ino
+
+    def test_dedup_session(self):
+        store = dedup.dedup_session(self.tmpdir)
+        self.assertEqual((store.total_bytes, store.saved_bytes), (1600, 800))
+        self.assertEqual(store.ratio(), 2.0)
+        self.assertEqual(self.inode('a/a1.ogg'), self.inode('b/b1.ogg'))
+        self.assertEqual(self.inode('a/a1.ogg'), self.inode('b/b2.ogg'))
+        self.assertNotEqual(self.inode('a/a1.ogg'), self.inode('a/a2.ogg'))
+        self.assertNotEqual(self.inode('a/a1.ogg'), self.inode('concat/alex_0.ogg'))
+        with open(os.path.join(self.tmpdir, 'b/b2.ogg'), 'rb') as f:
+            self.assertEqual(f.read(), b'loop' * 100)
+
+    def test_already_linked(self):
+        dedup.dedup_session(self.tmpdir)
+        store = dedup.dedup_session(self.tmpdir)
+        self.assertEqual((store.total_bytes, store.saved_bytes), (1600, 800))
+
+    def test_canonical_deleted(self):
+        store = dedup.ClipStore()
+        store.add(os.path.join(self.tmpdir, 'a/a1.ogg'))
+        os.remove(os.path.join(self.tmpdir, 'a/a1.ogg'))
+        store.add(os.path.join(self.tmpdir, 'b/b1.ogg'))
+        self.assertEqual(store.saved_bytes, 0)
+
+@unittest.skipIf(mix.numpy is None, 'numpy not installed')
+@unittest.skipIf(shutil.which(settings.avprog) is None, 'ffmpeg not installed')
+class LiveMixerTestCase(unittest.TestCase):
+    def test_mix_intervals(self):
+        fixture_dir = os.path.dirname(os.path.realpath(__file__))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(tmpdir, 'a'))
+            shutil.copy(os.path.join(fixture_dir, 'sine48k.ogg'), os.path.join(tmpdir, 'a', 'a1.ogg'))
+            shutil.copy(os.path.join(fixture_dir, 'drumloop.ogg'), os.path.join(tmpdir, 'a', 'a2.ogg'))
+            with open(os.path.join(tmpdir, 'clipsort.log'), 'wb') as f:
+                # Interval 1 has no uploads and interval 2 has a broken one
+                f.write(b'interval 0 120 16\nuser a1 "alex" 0 ch\nuser a2 "bob" 0 ch\n'
+                        b'interval 2 120 16\nuser a3 "alex" 0 ch\n')
+            cliplog = livemix.ClipLog(os.path.join(tmpdir, 'clipsort.log'))
+            cliplog.read()
+
+            output_filename = os.path.join(tmpdir, 'live.m4a')
+            builder = peaks.PeakBuilder(mix.SAMPLE_RATE, mix.CHANNELS) if peaks.numpy else None
+            mixer = livemix.LiveMixer(output_filename, limiter=0.9, peaks=builder)
+            for interval in cliplog.pop_ready(0):
+                mixer.add(interval)
+            self.assertEqual(mixer.finish(), 0)
+            self.assertEqual(mixer.frames, 3 * 8 * 48000)
+
+            samples = mix.decode_pcm(output_filename)
+            self.assertAlmostEqual(len(samples) / 2 / 48000, 24, delta=0.1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_repeated_upload_decoded_once(self):
+        fixture_dir = os.path.dirname(os.path.realpath(__file__))
+        tmpdir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(tmpdir, 'a'))
+            for guid in ('a1', 'a2', 'a3'):
+                shutil.copy(os.path.join(fixture_dir, 'drumloop.ogg'), os.path.join(tmpdir, 'a', guid + '.ogg'))
+            with open(os.path.join(tmpdir, 'clipsort.log'), 'wb') as f:
+                for i, guid in enumerate(('a1', 'a2', 'a3')):
+                    f.write(b'interval %d 120 16\nuser %s "bot" 0 drums\n' % (i, guid.encode()))
+            cliplog = livemix.ClipLog(os.path.join(tmpdir, 'clipsort.log'))
+            cliplog.read()
+
+            store = dedup.ClipStore()
+            mixer = livemix.LiveMixer(os.path.join(tmpdir, 'live.m4a'), store=store)
+            with mock.patch('mix.decode_pcm', wraps=mix.decode_pcm) as decode_pcm:
+                for interval in cliplog.pop_ready(0):
+                    mixer.add(interval)
+            self.assertEqual(mixer.finish(), 0)
+            self.assertEqual(decode_pcm.call_count, 1)
+            self.assertEqual(store.ratio(), 3.0)
+        finally:
+            shutil.rmtree(tmpdir)
+
+@unittest.skipIf(mix.numpy is None, 'numpy not installed')
+@unittest.skipIf(shutil.which(settings.avprog) is None, 'ffmpeg not installed')
+class SynthSessionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_generate(self):
+        session_dir = synth_session.generate(self.tmpdir, users=2, minutes=0.5, bpm=120, bpi=8,
+                                             repeat_ratio=0.5, idle_ratio=0.0, seed=1)
+        cliplog = livemix.ClipLog(os.path.join(session_dir, 'clipsort.log'))
+        cliplog.read()
+        intervals = cliplog.pop_ready(0)
+        self.assertEqual(len(intervals), 8)
+        self.assertEqual([len(interval.clips) for interval in intervals], [2] * 8)
+
+        # Unique uploads differ only in their comment and must still decode
+        filenames = dedup.interval_files(session_dir)
+        self.assertEqual(len(filenames), 16)
+        samples = mix.decode_pcm(filenames[0])
+        self.assertAlmostEqual(len(samples) / mix.CHANNELS / mix.SAMPLE_RATE, 4, delta=0.1)
+
+        store = dedup.dedup_session(session_dir)
+        self.assertGreater(store.saved_bytes, 0)
+        self.assertLess(store.saved_bytes, store.total_bytes)
+
+    def test_uniquify_checksum(self):
+        filename = os.path.join(self.tmpdir, 'template.ogg')
+        data = synth_session.encode_interval(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                          'drumloop.ogg'), 2.0, filename)
+        with open(filename, 'wb') as f:
+            f.write(synth_session.uniquify(data, b'x' * 32))
+        rc = subprocess.call([settings.avprog, '-loglevel', 'error', '-xerror', '-i', filename,
+                              '-f', 'null', '-'])
+        self.assertEqual(rc, 0)
+
+class StageTimerTestCase(unittest.TestCase):
+    def test_records(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'stats.jsonl')
+            stats = stagestats.StageTimer(path)
+            with stats.stage('concat'):
+                subprocess.check_call(['true'])
+            with stats.stage('zip'):
+                pass
+            with open(path, 'rt') as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual(records, stats.records)
+            self.assertEqual([r['stage'] for r in records], ['concat', 'zip'])
+            for r in records:
+                self.assertEqual(r['status'], 0)
+                self.assertGreaterEqual(r['wall'], 0)
+                self.assertGreaterEqual(r['cpu'], r['child_cpu'])
+                self.assertGreater(r['max_rss_kib'], 0)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_status(self):
+        stats = stagestats.StageTimer()
+        with self.assertRaises(SystemExit):
+            with stats.stage('concat'):
+                sys.exit(3)
+        with self.assertRaises(ValueError):
+            with stats.stage('upload'):
+                raise ValueError()
+        with stats.stage('stream') as record:
+            record['status'] = 1 # non-fatal failure
+        self.assertEqual([r['status'] for r in stats.records], [3, 1, 1])
+
+class RollingHistogramTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.clock = lambda: self.now
+
+    def test_buckets(self):
+        hist = stagestats.RollingHistogram((1, 10), 60, slots=6, clock=self.clock)
+        for value in (0.5, 1, 5, 100):
+            hist.add(value)
+        snapshot = hist.snapshot()
+        self.assertEqual(snapshot['le'], [1, 10, '+Inf'])
+        self.assertEqual(snapshot['counts'], [2, 3, 4])
+        self.assertEqual(snapshot['count'], 4)
+        self.assertEqual(snapshot['sum'], 106.5)
+
+    def test_rolling(self):
+        hist = stagestats.RollingHistogram((1,), 60, slots=6, clock=self.clock)
+        hist.add(2)
+        self.now = 35
+        hist.add(3)
+        self.now = 59
+        self.assertEqual(hist.snapshot()['count'], 2)
+        self.now = 60 # the first slot expires
+        self.assertEqual(hist.snapshot()['sum'], 3)
+        self.now = 1000
+        self.assertEqual(hist.snapshot()['count'], 0)
+
+    def test_stage_stats(self):
+        stats = stagestats.StageStats(60, clock=self.clock)
+        stats.add({'stage': 'mix', 'status': 0, 'wall': 30, 'cpu': 50, 'child_cpu': 45,
+                   'read_bytes': 0, 'write_bytes': 1 << 20})
+        stats.add({'stage': 'mix', 'status': 1, 'wall': 2})
+        snapshot = stats.snapshot()
+        self.assertEqual(list(snapshot), ['mix'])
+        self.assertEqual(snapshot['mix']['wall']['count'], 2)
+        self.assertEqual(snapshot['mix']['child_cpu']['count'], 1)
+        self.assertEqual(snapshot['mix']['write_bytes']['counts'][0], 1)
+        self.assertEqual(snapshot['mix']['failures'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,53 +3,314 @@
 
 import sys
 import os.path
+import json
+import random
 import socket
-from boto.s3.connection import S3Connection
+import threading
+import time
+import logging
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+from boto.s3.connection import S3Connection, OrdinaryCallingFormat
 from boto.s3.key import Key
+from boto.s3.multipart import MultiPartUpload
 
 __all__ = ['upload', 'override_socket_priority']
+log = logging.getLogger(__name__)
 
 MULTIPART_SIZE = 8 * 1024 * 1024
 
-def multipart_upload(bucket, basename, filename):
-    '''Upload file using S3 Multipart Upload (better reliability for large files)'''
-    multi = bucket.initiate_multipart_upload(basename, policy='public-read')
-    with open(filename, 'rb') as fp:
-        fp.seek(0, os.SEEK_END)
-        total_size = fp.tell()
-        fp.seek(0, os.SEEK_SET)
-
-        offset = 0
-        while offset < total_size:
-            part_num = 1 + (offset // MULTIPART_SIZE)
-            size = min(MULTIPART_SIZE, total_size - offset)
-            multi.upload_part_from_file(fp, part_num, size=size)
-            offset += size
-    multi.complete_upload()
+# Number of parts (or whole files) in flight at the same time
+MAX_WORKERS = 4
+
+# Attempts per part before giving up on the whole upload
+PART_RETRIES = 5
+
+# Delay before the first retry, doubled on each further attempt
+RETRY_DELAY = 1.0
+
+# Missing from older Python versions.  HLS players rely on it to recognize
+# playlists.
+mimetypes.add_type('application/vnd.apple.mpegurl', '.m3u8')
+
+class BucketFactory(object):
+    '''Hand out one S3 connection per thread
+
+    boto connections are not safe to share between threads, so each upload
+    worker lazily opens its own.
+    '''
+    def __init__(self, s3_host, s3_access_key, s3_secret_key, s3_bucket,
+                 s3_port=None, s3_is_secure=True, path_style=False):
+        self.s3_host = s3_host
+        self.s3_access_key = s3_access_key
+        self.s3_secret_key = s3_secret_key
+        self.s3_bucket = s3_bucket
+        self.s3_port = s3_port
+        self.s3_is_secure = s3_is_secure
+        self.path_style = path_style
+        self.local = threading.local()
+
+    def get_bucket(self):
+        bucket = getattr(self.local, 'bucket', None)
+        if bucket is None:
+            kwargs = {}
+            if self.path_style:
+                kwargs['calling_format'] = OrdinaryCallingFormat()
+            conn = S3Connection(self.s3_access_key, self.s3_secret_key,
+                                host=self.s3_host, port=self.s3_port,
+                                is_secure=self.s3_is_secure, **kwargs)
+            bucket = conn.get_bucket(self.s3_bucket, validate=False)
+            self.local.bucket = bucket
+        return bucket
+
+def retry(fn, what):
+    '''Call fn() until it succeeds, sleeping with exponential backoff between attempts'''
+    for attempt in range(PART_RETRIES):
+        try:
+            return fn()
+        except Exception:
+            if attempt == PART_RETRIES - 1:
+                raise
+            delay = RETRY_DELAY * (2 ** attempt) * random.uniform(0.5, 1.5)
+            log.warning('%s failed, retrying in %.1f seconds' % (what, delay), exc_info=True)
+            time.sleep(delay)
+
+class UploadState(object):
+    '''Upload progress saved to a JSON file so an interrupted upload can be resumed
+
+    For each file this records the multipart upload ID and the ETags of the
+    parts that have been uploaded.  Without a path the state is only kept in
+    memory.
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.files = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, 'rt') as f:
+                    self.files = json.load(f)
+            except ValueError:
+                log.exception('Ignoring corrupt upload state %s' % path)
+
+    def get(self, basename):
+        with self.lock:
+            return self.files.get(basename)
+
+    def start(self, basename, upload_id, size, part_size):
+        with self.lock:
+            self.files[basename] = {
+                'upload_id': upload_id,
+                'size': size,
+                'part_size': part_size,
+                'parts': {},
+                'done': False,
+            }
+            self.save()
+
+    def add_part(self, basename, part_num, etag):
+        with self.lock:
+            self.files[basename]['parts'][str(part_num)] = etag
+            self.save()
+
+    def finish(self, basename):
+        with self.lock:
+            self.files.setdefault(basename, {})['done'] = True
+            self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wt') as f:
+            json.dump(self.files, f)
+        os.replace(tmp_path, self.path)
+
+def upload_part(buckets, state, basename, upload_id, filename, part_num, offset, size):
+    '''Upload one part of a multipart upload and return its ETag'''
+    def attempt():
+        multi = MultiPartUpload(buckets.get_bucket())
+        multi.key_name = basename
+        multi.id = upload_id
+        with open(filename, 'rb') as fp:
+            fp.seek(offset, os.SEEK_SET)
+            key = multi.upload_part_from_file(fp, part_num, size=size)
+        return key.etag
+
+    etag = retry(attempt, 'Part %d of %s' % (part_num, basename))
+    state.add_part(basename, part_num, etag)
+    return etag
+
+def list_parts(bucket, basename, upload_id):
+    '''Return {part_num: etag} stored on the server or None if the upload is gone'''
+    multi = MultiPartUpload(bucket)
+    multi.key_name = basename
+    multi.id = upload_id
+
+    etags = {}
+    marker = None
+    while True:
+        parts = multi.get_all_parts(part_number_marker=marker)
+        if parts is None:
+            return None
+        for part in parts:
+            etags[part.part_number] = part.etag
+        if not multi.is_truncated:
+            return etags
+        marker = multi.next_part_number_marker
+
+def resume_parts(buckets, state, basename, total_size, part_size):
+    '''Return (upload_id, {part_num: etag}) of an upload to resume or (None, {})'''
+    saved = state.get(basename)
+    if not saved or saved.get('upload_id') is None:
+        return None, {}
+    if saved['size'] != total_size or saved['part_size'] != part_size:
+        log.info('%s changed since the last attempt, starting over' % basename)
+        return None, {}
+
+    stored = list_parts(buckets.get_bucket(), basename, saved['upload_id'])
+    if stored is None:
+        log.info('Upload %s of %s no longer exists, starting over' % (saved['upload_id'], basename))
+        return None, {}
+
+    # Only trust parts that both sides agree on
+    etags = {}
+    for part_num, etag in saved['parts'].items():
+        if stored.get(int(part_num)) == etag:
+            etags[int(part_num)] = etag
+    log.info('Resuming upload of %s with %d parts already done' % (basename, len(etags)))
+    return saved['upload_id'], etags
+
+def complete_xml(etags):
+    '''Return the CompleteMultipartUpload request body for {part_num: etag}'''
+    s = '<CompleteMultipartUpload>\n'
+    for part_num in sorted(etags):
+        s += '  <Part>\n'
+        s += '    <PartNumber>%d</PartNumber>\n' % part_num
+        s += '    <ETag>%s</ETag>\n' % etags[part_num]
+        s += '  </Part>\n'
+    s += '</CompleteMultipartUpload>'
+    return s
+
+def multipart_upload(buckets, state, basename, filename, executor, part_size=MULTIPART_SIZE):
+    '''Upload file using S3 Multipart Upload (better reliability for large files)
+
+    Parts are submitted to executor so they are sent over several connections
+    at once.  Returns a function that waits for the parts and completes the
+    upload.
+    '''
+    total_size = os.path.getsize(filename)
+    upload_id, done_etags = resume_parts(buckets, state, basename, total_size, part_size)
+    if upload_id is None:
+        bucket = buckets.get_bucket()
+        # Unlike single PUTs, boto does not guess the content type here
+        headers = {}
+        content_type = mimetypes.guess_type(basename)[0]
+        if content_type:
+            headers['Content-Type'] = content_type
+        multi = retry(lambda: bucket.initiate_multipart_upload(basename, headers=headers,
+                                                               policy='public-read'),
+                      'Initiating upload of %s' % basename)
+        upload_id = multi.id
+        state.start(basename, upload_id, total_size, part_size)
+
+    futures = {}
+    offset = 0
+    part_num = 1
+    while offset < total_size or part_num == 1:
+        size = min(part_size, total_size - offset)
+        if part_num not in done_etags:
+            futures[part_num] = executor.submit(upload_part, buckets, state, basename,
+                                                upload_id, filename, part_num, offset, size)
+        offset += size
+        part_num += 1
+
+    def finish():
+        try:
+            etags = dict(done_etags)
+            for part_num, f in futures.items():
+                etags[part_num] = f.result()
+            retry(lambda: buckets.get_bucket().complete_multipart_upload(basename, upload_id, complete_xml(etags)),
+                  'Completing upload of %s' % basename)
+        except:
+            for f in futures.values():
+                f.cancel()
+
+            # Keep the parts around if the upload can be resumed later
+            if state.path is None:
+                try:
+                    buckets.get_bucket().cancel_multipart_upload(basename, upload_id)
+                except Exception:
+                    log.exception('Failed to abort upload of %s' % basename)
+            raise
+        state.finish(basename)
+
+    return finish
+
+def simple_upload(buckets, state, basename, filename):
+    '''Upload file with a single PUT request'''
+    def attempt():
+        k = Key(buckets.get_bucket(), basename)
+        k.set_contents_from_filename(filename, policy='public-read')
+    retry(attempt, 'Upload of %s' % basename)
+    state.finish(basename)
 
 def upload(s3_host, s3_access_key, s3_secret_key, s3_bucket, filenames,
-           use_multipart_upload=True):
-    conn = S3Connection(s3_access_key, s3_secret_key, host=s3_host)
-    bucket = conn.get_bucket(s3_bucket, validate=False)
+           use_multipart_upload=True, max_workers=MAX_WORKERS,
+           s3_port=None, s3_is_secure=True, path_style=False,
+           part_size=MULTIPART_SIZE, state_path=None):
+    '''Upload files concurrently and return their URLs in the same order
+
+    If state_path is given, progress is saved there and a later call with the
+    same files picks up where an interrupted upload left off.
+    '''
+    buckets = BucketFactory(s3_host, s3_access_key, s3_secret_key, s3_bucket,
+                            s3_port=s3_port, s3_is_secure=s3_is_secure,
+                            path_style=path_style)
+    state = UploadState(state_path)
 
     urls = []
-    for filename in filenames:
-        basename = os.path.basename(filename)
-        if use_multipart_upload:
-            multipart_upload(bucket, basename, filename)
-        else:
-            k = Key(bucket, basename)
-            k.set_contents_from_filename(filename, policy='public-read')
-        urls.append('https://%s/%s/%s' % (s3_host, s3_bucket, basename))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Queue all parts of all files before waiting for any of them so the
+        # files are uploaded at the same time
+        waiters = []
+        for filename in filenames:
+            basename = os.path.basename(filename)
+            saved = state.get(basename)
+            if saved and saved.get('done'):
+                log.info('%s was already uploaded' % basename)
+            elif use_multipart_upload:
+                waiters.append(multipart_upload(buckets, state, basename, filename,
+                                                executor, part_size=part_size))
+            else:
+                waiters.append(executor.submit(simple_upload, buckets, state,
+                                               basename, filename).result)
+            urls.append('https://%s/%s/%s' % (s3_host, s3_bucket, basename))
+
+        # Wait for every file even if one fails so that no multipart upload
+        # is left behind un-aborted
+        error = None
+        for wait in waiters:
+            try:
+                wait()
+            except Exception as e:
+                log.exception('Upload failed')
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
     return urls
 
 def override_socket_priority():
     '''Force all opened TCP sockets to have priority TC_PRIO_FILLER'''
     old_socket = socket.socket
 
-    def new_socket(family=2, type=1, proto=0):
-        s = old_socket(family, type, proto)
-        if family == socket.AF_INET and type == socket.SOCK_STREAM and proto == 0:
+    def new_socket(family=socket.AF_INET, type=socket.SOCK_STREAM, proto=0, fileno=None):
+        s = old_socket(family, type, proto, fileno)
+        # getaddrinfo() hands out IPPROTO_TCP instead of 0 for the worker
+        # threads' connections
+        if family == socket.AF_INET and type == socket.SOCK_STREAM and \
+           proto in (0, socket.IPPROTO_TCP) and fileno is None:
             s.setsockopt(socket.SOL_SOCKET, socket.SO_PRIORITY, 1)
         return s
 
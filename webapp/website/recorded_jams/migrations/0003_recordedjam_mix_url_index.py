@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.26 on 2026-10-19 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recorded_jams', '0002_add_can_access_recorded_jams_perm'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recordedjam',
+            name='mix_url',
+            field=models.URLField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.26 on 2026-10-19 11:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recorded_jams', '0003_recordedjam_mix_url_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recordedjam',
+            name='peaks_url',
+            field=models.URLField(blank=True),
+        ),
+    ]
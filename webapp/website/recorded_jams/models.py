@@ -15,8 +15,10 @@ class RecordedJam(models.Model):
     start_date = models.DateTimeField()
     owner = models.ForeignKey('auth.User', null=True, blank=True, related_name='owned_jams')
     users = models.ManyToManyField('auth.User', related_name='recorded_jams')
-    mix_url = models.URLField()
+    mix_url = models.URLField(db_index=True)
     tracks_url = models.URLField()
+    peaks_url = models.URLField(blank=True)
+    stream_url = models.URLField(blank=True)
     duration = models.TimeField()
     server = models.CharField(max_length=128)
 
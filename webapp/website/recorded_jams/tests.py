@@ -4,6 +4,7 @@ import base64
 from django.contrib.auth.models import User, Permission
 from django.test import TestCase
 from website import jammr
+from .models import RecordedJam
 
 AUTH = 'basic ' + base64.b64encode(b'recorded-jams:password').decode('utf-8')
 ALEX_AUTH = 'basic ' + base64.b64encode(b'alex:password').decode('utf-8')
@@ -46,6 +47,43 @@ class PostRecordedJamTestCase(TestCase):
                                     HTTP_AUTHORIZATION=AUTH)
         self.assertEqual(response.status_code, 201)
 
+    def test_peaks_url(self):
+        data = dict(DATA_TEMPLATE)
+        data['peaks_url'] = 'http://test.jammr.net/mix.peaks'
+        response = self.client.post('/api/recorded-jams/',
+                                    data,
+                                    HTTP_AUTHORIZATION=AUTH)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(RecordedJam.objects.get().peaks_url, data['peaks_url'])
+
+    def test_stream_url(self):
+        data = dict(DATA_TEMPLATE)
+        data['stream_url'] = 'http://test.jammr.net/mix.m3u8'
+        response = self.client.post('/api/recorded-jams/',
+                                    data,
+                                    HTTP_AUTHORIZATION=AUTH)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(RecordedJam.objects.get().stream_url, data['stream_url'])
+
+    def test_invalid_peaks_url(self):
+        data = dict(DATA_TEMPLATE)
+        data['peaks_url'] = 'not a url'
+        response = self.client.post('/api/recorded-jams/',
+                                    data,
+                                    HTTP_AUTHORIZATION=AUTH)
+        self.assertEqual(response.status_code, 400)
+
+    def test_duplicate_mix_url(self):
+        response = self.client.post('/api/recorded-jams/',
+                                    DATA_TEMPLATE,
+                                    HTTP_AUTHORIZATION=AUTH)
+        self.assertEqual(response.status_code, 201)
+        response = self.client.post('/api/recorded-jams/',
+                                    DATA_TEMPLATE,
+                                    HTTP_AUTHORIZATION=AUTH)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(RecordedJam.objects.filter(mix_url=DATA_TEMPLATE['mix_url']).count(), 1)
+
     def test_missing_required_fields(self):
         for field in list(DATA_TEMPLATE.keys()):
             if field == 'owner': # this field is optional
@@ -144,7 +144,8 @@ class RecordedJamApiView(RestApiView):
                 logger.error('Invalid username \'%s\' in users list' % username)
                 return HttpResponseBadRequest('Bad Request')
 
-        for k in ('mix_url', 'tracks_url'):
+        optional_urls = tuple(k for k in ('peaks_url', 'stream_url') if k in request.POST)
+        for k in ('mix_url', 'tracks_url') + optional_urls:
             try:
                 URLValidator()(request.POST[k])
             except ValidationError:
@@ -156,9 +157,17 @@ class RecordedJamApiView(RestApiView):
             logger.error('Server string must be 128 characters or less')
             return HttpResponseBadRequest('Bad Request')
 
+        # recorded_jamsd retries failed jobs with the same upload URLs, don't
+        # add the same recorded jam twice
+        if RecordedJam.objects.filter(mix_url=request.POST['mix_url']).exists():
+            logger.info('Recorded jam with mix URL \'%s\' already exists' % request.POST['mix_url'])
+            return HttpResponse('OK', status=200)
+
         jam = RecordedJam.objects.create(start_date=start_date,
                                          mix_url=request.POST['mix_url'],
                                          tracks_url=request.POST['tracks_url'],
+                                         peaks_url=request.POST.get('peaks_url', ''),
+                                         stream_url=request.POST.get('stream_url', ''),
                                          duration=duration,
                                          server=server,
                                          owner=owner)